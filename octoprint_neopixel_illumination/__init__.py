@@ -1,44 +1,116 @@
 # coding=utf-8
 from __future__ import absolute_import
 
+import base64
 import os
 import subprocess
 import sys
+import threading
+import time
+from types import MappingProxyType
 
+import flask
+import octoprint.filemanager
+import octoprint.filemanager.util
 import octoprint.plugin
+from octoprint.events import Events
 
+from .gcode import M150IndexStream, load_index, parse_m150, remove_index
+from .metrics import Metrics
 from .mocks import neopixel
 from .mocks.microcontroller import Pin
 from .mocks.neopixel import (
+    OVERFLOW_COALESCE,
+    OVERFLOW_POLICIES,
     HttpNeoPixelDelegate,
     LoggingNeoPixelDelegate,
     SocketNeoPixelDelegate,
     demo,
+    request_stats,
     wheel,
 )
+from .protocol import (
+    BYTES_PER_PIXEL,
+    EFFECT_RESERVED_PARAMS,
+    EFFECTS,
+    LAYER_ALERT,
+    LAYER_BASE,
+    LAYER_GCODE,
+    LAYER_STATUS,
+    LAYER_TEMPERATURE,
+    LAYERS,
+    READY_MESSAGE,
+)
+from .sharedframe import SHARED_FRAME_PATH
+from .temperature import TEMPERATURE_GRADIENT, TemperatureQuantizer
+from .worker import PixelOutputWorker, Throttle
 
 SOCKET_SERVER_ADDRESS = "/tmp/neopixel_socket"
 
+ALERT_DURATION = 30.0
+API_READY_TIMEOUT = 10.0
+API_STATE_FILENAME = "api_state.json"
+M150_INDEX_FOLDER = "m150_index"
+
 BRIGHTNESS_KEY = "brightness"
+EFFECT_NAME_KEY = "name"
+EFFECT_PARAMS_KEY = "params"
 COLOR_KEY = "color"
+DONE_COLOR_KEY = "done_color"
 ENABLED_KEY = "enabled"
+ERROR_COLOR_KEY = "error_color"
+FRAME_KEY = "frame"
+FRAME_SEQUENCE_KEY = "seq"
+FRAME_START_KEY = "start"
+HEATING_COLOR_KEY = "heating_color"
+HEATING_GCODES = frozenset(["M109", "M190", "m109", "m190"])
+IDLE_BRIGHTNESS_KEY = "idle_brightness"
+IDLE_TIMEOUT_KEY = "idle_timeout"
 JSON_HEADERS = {"Content-type": "application/json"}
+MAX_UPDATE_RATE_DEFAULT = 20
+MAX_UPDATE_RATE_KEY = "max_update_rate"
 NEOPIXEL_API_HOST = "localhost:5001"
 NEOPIXEL_API_HOST_KEY = "neopixel_api_host"
 NEOPIXEL_API_SOCKET = "/tmp/neopixel_socket"
 NUM_PIXELS_KEY = "num_pixels"
+OVERFLOW_POLICY_KEY = "overflow_policy"
 PARSE_GCODE_KEY = "parse_gcode"
 PIXEL_ORDER_KEY = "pixel_order"
 PIXEL_PIN_KEY = "pixel_pin"
+PRESET_COMMAND = "preset"
+PRESET_NAME_KEY = "name"
+PRESETS_KEY = "presets"
+PROGRESS_COLOR_KEY = "progress_color"
 SAVE_COLOR_COMMAND = "save_color"
 SAVE_BRIGHTNESS_COMMAND = "save_brightness"
 SET_COLOR_GCODE = "M150"
+SET_FRAME_COMMAND = "set_frame"
+# A frame this many sequence numbers or fewer behind the last one is stale, further behind is a restarted stream.
+SEQUENCE_WINDOW = 1024
+SHARED_MEMORY_KEY = "shared_memory"
+START_EFFECT_COMMAND = "start_effect"
+STOP_EFFECT_COMMAND = "stop_effect"
+STRIPS_KEY = "strips"
+STRIP_KEY = "strip"
+TRANSITION_COMMAND = "transition"
+TRANSITION_DURATION_KEY = "duration"
+SET_COLOR_GCODES = frozenset([SET_COLOR_GCODE, SET_COLOR_GCODE.lower()])
 STARTUP_COLOR_KEY = "startup_color"
+STATUS_HEATING = "heating"
+STATUS_LIGHTING_KEY = "status_lighting"
+STATUS_PRINTING = "printing"
 SUDO_DEFAULT_PASSWORD = "raspberry"
 SUDO_PASSWORD_KEY = "sudo_password"
+TEMPERATURE_LIGHTING_KEY = "temperature_lighting"
 UPDATE_BRIGHTNESS_COMMAND = "update_brightness"
 UPDATE_COLOR_COMMAND = "update_color"
 
+# Sensors shown by temperature lighting, each on an equal share of the strip, with their cold and hot temperatures.
+TEMPERATURE_SENSORS = {
+    "T0": (30.0, 250.0),
+    "B": (30.0, 110.0),
+}
+
 PIXEL_ORDER_LIST = [
     neopixel.GRB,
     neopixel.GRBW,
@@ -47,13 +119,38 @@ PIXEL_ORDER_LIST = [
 ]
 
 CONFIG_ITEMS = [
+    BRIGHTNESS_KEY,
+    DONE_COLOR_KEY,
     ENABLED_KEY,
+    ERROR_COLOR_KEY,
+    HEATING_COLOR_KEY,
+    IDLE_BRIGHTNESS_KEY,
+    IDLE_TIMEOUT_KEY,
     NUM_PIXELS_KEY,
+    OVERFLOW_POLICY_KEY,
+    PARSE_GCODE_KEY,
     PIXEL_ORDER_KEY,
     PIXEL_PIN_KEY,
-    SUDO_PASSWORD_KEY
+    PRESETS_KEY,
+    PROGRESS_COLOR_KEY,
+    SHARED_MEMORY_KEY,
+    STARTUP_COLOR_KEY,
+    STATUS_LIGHTING_KEY,
+    STRIPS_KEY,
+    SUDO_PASSWORD_KEY,
+    TEMPERATURE_LIGHTING_KEY,
 ]
 
+# Changing any of these needs a new strip, the rest are applied to the running one.
+REINIT_CONFIG_ITEMS = frozenset([
+    ENABLED_KEY,
+    NUM_PIXELS_KEY,
+    PIXEL_ORDER_KEY,
+    PIXEL_PIN_KEY,
+    SHARED_MEMORY_KEY,
+    STRIPS_KEY,
+])
+
 
 class NeopixelIlluminationPlugin(
     octoprint.plugin.SettingsPlugin,
@@ -61,32 +158,94 @@ class NeopixelIlluminationPlugin(
     octoprint.plugin.TemplatePlugin,
     octoprint.plugin.StartupPlugin,
     octoprint.plugin.EventHandlerPlugin,
+    octoprint.plugin.ProgressPlugin,
     octoprint.plugin.SimpleApiPlugin,
     octoprint.plugin.ShutdownPlugin,
     octoprint.plugin.RestartNeedingPlugin,
 ):
     def __init__(self):
         super().__init__()
-        self._config: dict = {}
+        self._config: MappingProxyType = MappingProxyType({})
+        self._watch_gcode: bool = False
+        self._watch_status: bool = False
+        self._watch_temperature: bool = False
+        self._temperatures = {}
+        self._m150_index = {}
+        self._frame_sequences = {}
+        # Presets by name as (color, brightness), their names in settings order, and their frames rendered per strip.
+        self._presets = {}
+        self._preset_names = []
+        self._preset_frames = {}
+        self._frame_sequence_lock = threading.Lock()
+        self._status: str = None
+        self._progress_pixels: int = None
         self._current_brightness: float = None
         self._current_color: str = None
         self._pixels: neopixel.NeoPixel = None
+        self._layers = {}
+        # Layers of every strip by strip index, the main strip being 0.
+        self._strips = {}
+        # Layers written since they were last cleared, so clearing the others costs nothing.
+        self._covered_layers = set()
+        self._alert_timer: threading.Timer = None
+        # Any use of the strips counts as activity, without any for the idle timeout they are dimmed.
+        self._last_activity = time.monotonic()
+        self._idle_timer: threading.Timer = None
+        self._idle_lock = threading.Lock()
+        self._dimmed = False
+        self._idle_dims = 0
+        # Brightness of each strip from before it was dimmed, only touched on the output thread.
+        self._undimmed = {}
         self._api_process: subprocess.Popen = None
-        self._delegate: SocketNeoPixelDelegate = None
+        self._api_started: float = None
+        self._api_ready = threading.Event()
+        self._delegates = {}
+        self._output: PixelOutputWorker = None
+        # Counters of the output worker and every strip's delegate, and the time G-code handling takes.
+        self._metrics = Metrics()
+        self._gcode_time = self._metrics.histogram("gcode_time")
+        self._throttles = {
+            UPDATE_COLOR_COMMAND: Throttle(MAX_UPDATE_RATE_DEFAULT),
+            UPDATE_BRIGHTNESS_COMMAND: Throttle(MAX_UPDATE_RATE_DEFAULT),
+        }
+
+    def initialize(self):
+        # Runs once the logger is injected and before any hook, event or API call can queue output.
+        self._output = PixelOutputWorker(self._logger, idle=self._flush_output, metrics=self._metrics)
+        self._output.start()
 
     ##~~ SettingsPlugin mixin
 
     def get_settings_defaults(self):
         return {
             BRIGHTNESS_KEY: 1.0,
+            DONE_COLOR_KEY: "#00ff00",
             ENABLED_KEY: False,
+            ERROR_COLOR_KEY: "#ff0000",
+            HEATING_COLOR_KEY: "#ff6000",
+            IDLE_BRIGHTNESS_KEY: 0.1,
+            # Minutes, 0 never dims.
+            IDLE_TIMEOUT_KEY: 0,
+            MAX_UPDATE_RATE_KEY: MAX_UPDATE_RATE_DEFAULT,
             NEOPIXEL_API_HOST_KEY: NEOPIXEL_API_SOCKET,
             NUM_PIXELS_KEY: 24,
+            OVERFLOW_POLICY_KEY: OVERFLOW_COALESCE,
             PIXEL_ORDER_KEY: neopixel.GRBW,
             PIXEL_PIN_KEY: 18,
+            PRESETS_KEY: [
+                {PRESET_NAME_KEY: "work", COLOR_KEY: "#ffffff", BRIGHTNESS_KEY: 1.0},
+                {PRESET_NAME_KEY: "camera", COLOR_KEY: "#fff4e0", BRIGHTNESS_KEY: 0.6},
+                {PRESET_NAME_KEY: "night", COLOR_KEY: "#ff2000", BRIGHTNESS_KEY: 0.05},
+            ],
+            PROGRESS_COLOR_KEY: "#0000ff",
             STARTUP_COLOR_KEY: "#ffffff",
+            STATUS_LIGHTING_KEY: False,
             PARSE_GCODE_KEY: False,
-            SUDO_PASSWORD_KEY: SUDO_DEFAULT_PASSWORD
+            SHARED_MEMORY_KEY: False,
+            # Strips on other pins, each a dict of pixel_pin, num_pixels and pixel_order. M150 S<n> addresses strip n.
+            STRIPS_KEY: [],
+            SUDO_PASSWORD_KEY: SUDO_DEFAULT_PASSWORD,
+            TEMPERATURE_LIGHTING_KEY: False,
         }
 
     def get_settings_restricted_paths(self):
@@ -114,7 +273,10 @@ class NeopixelIlluminationPlugin(
         ]
 
     def get_template_vars(self):
-        return {"pixel_order_list": PIXEL_ORDER_LIST}
+        return {
+            "overflow_policy_list": OVERFLOW_POLICIES,
+            "pixel_order_list": PIXEL_ORDER_LIST,
+        }
 
     ##~~ AssetPlugin mixin
 
@@ -152,21 +314,65 @@ class NeopixelIlluminationPlugin(
         }
 
     def on_settings_initialized(self):
-        self._config = {
-            setting_name: self._settings.get([setting_name])
-            for setting_name in CONFIG_ITEMS
-        }
+        self._snapshot_config()
 
     def on_settings_save(self, data):
+        old_config = self._config
         diff = super().on_settings_save(data)
-        self._initialize_pixel()
+        self._snapshot_config()
+        # Saving settings is activity too, and the timeout may have changed.
+        self._touch()
+        self._reconfigure_pixel(old_config)
+        self._schedule_idle()
 
         return diff
 
-    def on_after_startup(self):
+    def on_startup(self, host, port):
+        # Start the api as early as possible, it restores the last frame on its own while OctoPrint finishes loading.
         sudo_password = self._settings.get([SUDO_PASSWORD_KEY])
         self._initialize_api(sudo_password)
+
+    def on_after_startup(self):
         self._initialize_pixel()
+        self._schedule_idle()
+
+    ##~~ EventHandlerPlugin mixin
+
+    def on_event(self, event, payload):
+        if event in (Events.PRINT_STARTED, Events.PRINT_DONE, Events.PRINT_FAILED):
+            self._touch()
+
+        if event == Events.PRINT_STARTED and payload.get("origin") == "local":
+            self._m150_index = load_index(self._m150_index_folder(), payload["path"])
+        elif event in (Events.PRINT_DONE, Events.PRINT_FAILED):
+            self._m150_index = {}
+        elif event == Events.FILE_REMOVED and payload.get("storage") == "local":
+            remove_index(self._m150_index_folder(), payload["path"])
+
+        if not self._watch_status:
+            return
+
+        if event == Events.PRINT_STARTED:
+            self._status = STATUS_PRINTING
+            self._progress_pixels = None
+            self._show_progress(0)
+        elif event == Events.PRINT_DONE:
+            self._end_status()
+            self._show_alert(DONE_COLOR_KEY)
+        elif event == Events.PRINT_FAILED and payload.get("reason") == "cancelled":
+            # Back to plain illumination, a cancel is not an error.
+            self._end_status()
+        elif event in (Events.PRINT_FAILED, Events.ERROR):
+            self._end_status()
+            self._show_alert(ERROR_COLOR_KEY)
+
+    ##~~ ProgressPlugin mixin
+
+    def on_print_progress(self, storage, path, progress):
+        if self._watch_status:
+            self._show_progress(progress)
+
+    ##~~ SimpleApiPlugin mixin
 
     def get_api_commands(self):
         return {
@@ -174,23 +380,93 @@ class NeopixelIlluminationPlugin(
             SAVE_COLOR_COMMAND: [],
             UPDATE_BRIGHTNESS_COMMAND: ["value"],
             SAVE_BRIGHTNESS_COMMAND: [],
+            START_EFFECT_COMMAND: [EFFECT_NAME_KEY],
+            STOP_EFFECT_COMMAND: [],
+            TRANSITION_COMMAND: [COLOR_KEY],
+            SET_FRAME_COMMAND: [FRAME_KEY],
+            PRESET_COMMAND: [PRESET_NAME_KEY],
         }
 
+    def on_api_get(self, request):
+        try:
+            api_stats = request_stats(SOCKET_SERVER_ADDRESS)
+        except (OSError, ValueError, KeyError) as e:
+            self._logger.debug("NeoPixel api stats unavailable: {}".format(e))
+            api_stats = None
+        return flask.jsonify(
+            idle={"dimmed": self._dimmed, "dims": self._idle_dims},
+            metrics=self._metrics.snapshot(),
+            api=api_stats,
+        )
+
     def on_api_command(self, command, data):
+        if command == START_EFFECT_COMMAND:
+            # The daemon would only log a bad effect, and the delegate would replay it on every reconnect.
+            name = data[EFFECT_NAME_KEY]
+            params = data.get(EFFECT_PARAMS_KEY) or {}
+            if name not in EFFECTS:
+                return flask.abort(400, description="Unknown effect `{}`".format(name))
+            if not isinstance(params, dict) or EFFECT_RESERVED_PARAMS.intersection(params):
+                return flask.abort(400, description="Invalid params for effect `{}`".format(name))
+
+        self._touch()
+
+        if command in (UPDATE_COLOR_COMMAND, START_EFFECT_COMMAND, STOP_EFFECT_COMMAND, TRANSITION_COMMAND, PRESET_COMMAND):
+            # A color picked in the UI replaces whatever the G-code last set.
+            self._clear_layer(LAYER_GCODE)
+        if command in (START_EFFECT_COMMAND, STOP_EFFECT_COMMAND, TRANSITION_COMMAND, PRESET_COMMAND):
+            # A throttled color update still waiting to run would overwrite what these show.
+            self._throttles[UPDATE_COLOR_COMMAND].cancel()
+
         if command == UPDATE_COLOR_COMMAND:
             self._current_color = data[COLOR_KEY]
-            self._set_pixels(self._current_color)
+            self._throttles[command].call(self._set_pixels, self._current_color)
         elif command == SAVE_COLOR_COMMAND:
             self._settings.set([STARTUP_COLOR_KEY], self._current_color)
             self._settings.save()
         elif command == UPDATE_BRIGHTNESS_COMMAND:
             self._current_brightness = float(data["value"])
-            self._set_brightness(self._current_brightness)
+            self._throttles[command].call(self._set_brightness, self._current_brightness)
         elif command == SAVE_BRIGHTNESS_COMMAND:
             self._settings.set([BRIGHTNESS_KEY], self._current_brightness)
             self._settings.save()
+        elif command == START_EFFECT_COMMAND:
+            self._start_effect(data[EFFECT_NAME_KEY], data.get(EFFECT_PARAMS_KEY) or {})
+        elif command == STOP_EFFECT_COMMAND:
+            # Any fill takes the strip back from the effect.
+            self._set_pixels(self._current_color)
+        elif command == TRANSITION_COMMAND:
+            self._current_color = data[COLOR_KEY]
+            brightness = data.get(BRIGHTNESS_KEY)
+            if brightness is not None:
+                self._throttles[UPDATE_BRIGHTNESS_COMMAND].cancel()
+                brightness = self._current_brightness = float(brightness)
+            self._transition(
+                self._parse_color(self._current_color),
+                brightness,
+                float(data.get(TRANSITION_DURATION_KEY, 1.0)),
+            )
+        elif command == SET_FRAME_COMMAND:
+            return self._set_frame(data)
+        elif command == PRESET_COMMAND:
+            name = data[PRESET_NAME_KEY]
+            if name not in self._presets:
+                return flask.abort(400, description="Unknown preset `{}`".format(name))
+            if self._presets[name][1] is not None:
+                self._throttles[UPDATE_BRIGHTNESS_COMMAND].cancel()
+            self._show_preset(name)
 
     def on_shutdown(self):
+        for throttle in self._throttles.values():
+            throttle.cancel()
+        if self._alert_timer is not None:
+            self._alert_timer.cancel()
+        with self._idle_lock:
+            if self._idle_timer is not None:
+                self._idle_timer.cancel()
+        self._output.stop(5)
+        for delegate in self._delegates.values():
+            delegate.close()
         if self._api_process is not None:
             try:
                 passwd_process = subprocess.Popen(["echo", (self._settings.get([SUDO_PASSWORD_KEY]))], stdout=subprocess.PIPE)
@@ -211,9 +487,49 @@ class NeopixelIlluminationPlugin(
                     sys.executable,
                     api_filename,
                     "-l",
-                    self._settings.get_plugin_logfile_path(postfix="api")
-                ], stdin=passwd_process.stdout)
+                    self._settings.get_plugin_logfile_path(postfix="api"),
+                    "-s",
+                    os.path.join(self.get_plugin_data_folder(), API_STATE_FILENAME),
+                ], stdin=passwd_process.stdout, stdout=subprocess.PIPE, universal_newlines=True)
+            self._api_started = time.monotonic()
             self._logger.info("Started NeoPixel api {} `{}`".format(self._api_process.pid, " ".join(self._api_process.args)))
+            threading.Thread(target=self._watch_api_output, name="NeoPixelApiOutput", daemon=True).start()
+
+    def _watch_api_output(self):
+        # Drains the api's stdout so it never blocks on a full pipe, and flags when it accepts connections.
+        for line in self._api_process.stdout:
+            if not self._api_ready.is_set() and line.strip() == READY_MESSAGE:
+                self._logger.info("NeoPixel api ready after {:.0f} ms".format((time.monotonic() - self._api_started) * 1000))
+                self._api_ready.set()
+        if not self._api_ready.is_set():
+            # It exited without ever getting ready, e.g. a wrong sudo password, so there is nothing to wait for.
+            self._logger.error("NeoPixel api exited with {} before it was ready".format(self._api_process.wait()))
+            self._api_ready.set()
+
+    def _snapshot_config(self):
+        # Read-only copy of the settings used on hot paths, so they don't walk the settings tree on every call.
+        self._config = MappingProxyType({
+            setting_name: self._settings.get([setting_name])
+            for setting_name in CONFIG_ITEMS
+        })
+        self._watch_gcode = bool(self._config[ENABLED_KEY] and self._config[PARSE_GCODE_KEY])
+        self._watch_status = bool(self._config[ENABLED_KEY] and self._config[STATUS_LIGHTING_KEY])
+        self._watch_temperature = bool(self._config[ENABLED_KEY] and self._config[TEMPERATURE_LIGHTING_KEY])
+
+        presets = [preset for preset in self._config[PRESETS_KEY] or [] if preset.get(PRESET_NAME_KEY)]
+        self._presets = {
+            preset[PRESET_NAME_KEY]: (
+                preset[COLOR_KEY],
+                float(preset[BRIGHTNESS_KEY]) if preset.get(BRIGHTNESS_KEY) not in (None, "") else None,
+            )
+            for preset in presets
+        }
+        self._preset_names = [preset[PRESET_NAME_KEY] for preset in presets]
+        self._preset_frames = {}
+
+        max_update_rate = self._settings.get_float([MAX_UPDATE_RATE_KEY])
+        for throttle in self._throttles.values():
+            throttle.set_rate(max_update_rate)
 
     def _parse_color(self, hex_color: str):
         if hex_color.startswith("#"):
@@ -226,14 +542,159 @@ class NeopixelIlluminationPlugin(
             return red, green, blue, white
 
     def _set_brightness(self, value: float):
-        if self._settings.get_boolean([ENABLED_KEY]):
-            self._pixels.brightness = value
-            self._pixels.show()
+        if self._config[ENABLED_KEY]:
+            self._output.submit("brightness", self._write_brightness, value)
+            self._output.submit(("show", LAYER_BASE), self._write_show, LAYER_BASE)
+
+    def _set_pixels(self, hex_color: str, layer: str = LAYER_BASE):
+        if self._config[ENABLED_KEY]:
+            self._covered_layers.add(layer)
+            self._output.submit(("fill", layer), self._write_fill, layer, self._parse_color(hex_color))
+            self._output.submit(("show", layer), self._write_show, layer)
+
+    def _clear_layer(self, layer: str):
+        if self._config[ENABLED_KEY] and layer in self._covered_layers:
+            self._covered_layers.discard(layer)
+            # Shares the fill key, the last of a clear and a fill wins.
+            self._output.submit(("fill", layer), self._write_clear, layer)
+            self._output.submit(("show", layer), self._write_show, layer)
+
+    def _show_status(self, status: str, color_key: str):
+        if status != self._status:
+            self._status = status
+            self._progress_pixels = None
+            self._set_pixels(self._config[color_key], LAYER_STATUS)
+
+    def _end_status(self):
+        self._status = None
+        self._progress_pixels = None
+        self._clear_layer(LAYER_STATUS)
+
+    def _show_alert(self, color_key: str):
+        # Alerts sit on top of everything for a while, then uncover the layers below.
+        if self._alert_timer is not None:
+            self._alert_timer.cancel()
+        self._set_pixels(self._config[color_key], LAYER_ALERT)
+        self._alert_timer = threading.Timer(ALERT_DURATION, self._clear_layer, (LAYER_ALERT,))
+        self._alert_timer.daemon = True
+        self._alert_timer.start()
+
+    def _show_progress(self, progress: int):
+        # Quantized to whole pixels, most progress callbacks don't change what the strip shows.
+        num_pixels = int(self._config[NUM_PIXELS_KEY])
+        lit = min(progress * num_pixels // 100, num_pixels)
+        if lit == self._progress_pixels:
+            return
+        # Whatever else the status layer showed goes, the bar only covers its lit pixels.
+        reset = self._progress_pixels is None
+        self._covered_layers.add(LAYER_STATUS)
+        self._status = STATUS_PRINTING
+        self._progress_pixels = lit
+        self._output.submit(
+            ("fill", LAYER_STATUS),
+            self._write_progress,
+            lit,
+            self._parse_color(self._config[PROGRESS_COLOR_KEY]),
+            reset,
+        )
+
+    def _show_preset(self, name: str):
+        if self._config[ENABLED_KEY]:
+            self._current_color, brightness = self._presets[name]
+            if brightness is not None:
+                self._current_brightness = brightness
+            # Shares the fill key, a preset replaces the whole layer like a fill.
+            self._output.submit(("fill", LAYER_BASE), self._write_preset, LAYER_BASE, name)
+            self._output.submit(("show", LAYER_BASE), self._write_show, LAYER_BASE)
 
-    def _set_pixels(self, hex_color: str):
-        if self._settings.get_boolean([ENABLED_KEY]):
-            self._pixels.fill(self._parse_color(hex_color))
-            self._pixels.show()
+    def _touch(self):
+        self._last_activity = time.monotonic()
+        if self._dimmed:
+            with self._idle_lock:
+                if not self._dimmed:
+                    return
+                self._dimmed = False
+                self._output.submit("idle", self._write_idle, False)
+            self._schedule_idle()
+
+    def _schedule_idle(self):
+        # One timer at a time, activity only moves the timestamp it checks when it fires.
+        with self._idle_lock:
+            if self._idle_timer is not None:
+                self._idle_timer.cancel()
+                self._idle_timer = None
+            timeout = float(self._config[IDLE_TIMEOUT_KEY] or 0) * 60
+            if not self._config[ENABLED_KEY] or timeout <= 0 or self._dimmed:
+                return
+            delay = max(self._last_activity + timeout - time.monotonic(), 0)
+            self._idle_timer = threading.Timer(delay, self._check_idle)
+            self._idle_timer.daemon = True
+            self._idle_timer.start()
+
+    def _check_idle(self):
+        timeout = float(self._config[IDLE_TIMEOUT_KEY] or 0) * 60
+        if self._config[ENABLED_KEY] and timeout > 0 and time.monotonic() - self._last_activity >= timeout:
+            if self._printer.is_printing():
+                # Keep the light up for the camera, a running print counts as activity.
+                self._last_activity = time.monotonic()
+            else:
+                with self._idle_lock:
+                    self._dimmed = True
+                    self._idle_dims += 1
+                    self._output.submit("idle", self._write_idle, True)
+        self._schedule_idle()
+
+    def _start_effect(self, name: str, params: dict):
+        if self._config[ENABLED_KEY]:
+            self._output.submit(("effect", LAYER_BASE), self._write_effect, LAYER_BASE, name, params)
+
+    def _transition(self, color, brightness: float, duration: float, layer: str = LAYER_BASE):
+        if self._config[ENABLED_KEY]:
+            self._covered_layers.add(layer)
+            # Shares the fill key, a transition and a fill both replace the whole layer.
+            self._output.submit(("fill", layer), self._write_transition, layer, color, brightness, duration)
+
+    def _set_frame(self, data: dict):
+        # Requests can overtake each other, so a sequence number drops frames older than one already taken.
+        try:
+            strip = int(data.get(STRIP_KEY, 0))
+            start = int(data.get(FRAME_START_KEY, 0))
+            sequence = data.get(FRAME_SEQUENCE_KEY)
+            sequence = int(sequence) if sequence is not None else None
+            frame = base64.b64decode(data[FRAME_KEY], validate=True)
+        except (TypeError, ValueError) as e:
+            return flask.abort(400, description="Invalid frame: {}".format(e))
+
+        num_pixels = self._strip_length(strip)
+        if num_pixels is None:
+            return flask.abort(400, description="Unknown strip {}".format(strip))
+        if len(frame) % BYTES_PER_PIXEL or start < 0 or start + len(frame) // BYTES_PER_PIXEL > num_pixels:
+            return flask.abort(400, description="Frame does not fit strip {} of {} pixels".format(strip, num_pixels))
+
+        if not self._config[ENABLED_KEY] or not self._accept_sequence(strip, sequence):
+            return
+        if strip == 0:
+            self._clear_layer(LAYER_GCODE)
+        # Frames of the same span coalesce, a tool streaming faster than the strip updates only skips frames.
+        self._output.submit(("frame", strip, start, len(frame)), self._write_frame, strip, start, frame)
+
+    def _accept_sequence(self, strip: int, sequence: int) -> bool:
+        if sequence is None:
+            return True
+        with self._frame_sequence_lock:
+            last = self._frame_sequences.get(strip)
+            if last is not None and 0 <= last - sequence < SEQUENCE_WINDOW:
+                return False
+            self._frame_sequences[strip] = sequence
+        return True
+
+    def _strip_length(self, strip: int) -> int:
+        if strip == 0:
+            return int(self._config[NUM_PIXELS_KEY])
+        extra_strips = self._config[STRIPS_KEY] or []
+        if 0 < strip <= len(extra_strips):
+            return int(extra_strips[strip - 1][NUM_PIXELS_KEY])
+        return None
 
     def _initialize_pixel(self):
         enabled = self._settings.get_boolean(["enabled"])
@@ -243,68 +704,340 @@ class NeopixelIlluminationPlugin(
             pixel_order = self._settings.get(["pixel_order"])
             pixel_pin = self._settings.get_int(["pixel_pin"])
             self._current_color = self._settings.get(["startup_color"])
+            shared_memory = self._settings.get_boolean([SHARED_MEMORY_KEY])
+            overflow_policy = self._settings.get([OVERFLOW_POLICY_KEY])
+            extra_strips = [
+                (int(strip[PIXEL_PIN_KEY]), int(strip[NUM_PIXELS_KEY]), strip[PIXEL_ORDER_KEY])
+                for strip in self._settings.get([STRIPS_KEY]) or []
+            ]
 
-            delegate = SocketNeoPixelDelegate(SOCKET_SERVER_ADDRESS, self._logger)
-
-            self._pixels = neopixel.NeoPixel(
-                Pin(pixel_pin),
+            # A new strip starts with only its base layer.
+            self._covered_layers.clear()
+            self._temperatures = {}
+            self._progress_pixels = None
+            self._status = None
+            # New strips start at the configured brightness.
+            self._dimmed = False
+            self._output.submit(
+                "init",
+                self._create_pixels,
+                pixel_pin,
                 int(num_pixels),
-                brightness=self._current_brightness,
-                auto_write=False,
-                pixel_order=pixel_order,
-                delegate=delegate,
+                self._current_brightness,
+                pixel_order,
+                shared_memory,
+                overflow_policy,
+                extra_strips,
             )
+            self._set_pixels(self._current_color)
+
+    def _reconfigure_pixel(self, old_config: MappingProxyType):
+        config = self._config
+        if not config[ENABLED_KEY]:
+            return
+
+        changed = {key for key in CONFIG_ITEMS if config[key] != old_config.get(key)}
+        if self._pixels is None or changed & REINIT_CONFIG_ITEMS:
+            self._initialize_pixel()
+            return
 
-            # demo(self._pixels)
+        if OVERFLOW_POLICY_KEY in changed:
+            self._output.submit("overflow_policy", self._write_overflow_policy, config[OVERFLOW_POLICY_KEY])
+        if BRIGHTNESS_KEY in changed:
+            self._current_brightness = float(config[BRIGHTNESS_KEY])
+            self._set_brightness(self._current_brightness)
+        if STARTUP_COLOR_KEY in changed:
+            self._current_color = config[STARTUP_COLOR_KEY]
             self._set_pixels(self._current_color)
+        if TEMPERATURE_LIGHTING_KEY in changed:
+            # Start over, the next report draws every sensor again.
+            self._temperatures = {}
+            self._clear_layer(LAYER_TEMPERATURE)
+        if STATUS_LIGHTING_KEY in changed and not config[STATUS_LIGHTING_KEY]:
+            # Events stop updating the status, so take down what it shows now rather than leave it up for good.
+            if self._alert_timer is not None:
+                self._alert_timer.cancel()
+                self._alert_timer = None
+            self._end_status()
+            self._clear_layer(LAYER_ALERT)
 
-    def process_gcode(self, comm, phase, cmd: str, cmd_type, gcode, subcode, tags):
-        # M150 [B<intensity>] [I<pixel>] [P<intensity>] [R<intensity>] [S<strip>] [U<intensity>] [W<intensity>]
-        # M150 B100 R255 U50 W0
-        if (
-            self._settings.get([ENABLED_KEY])
-            and self._settings.get([PARSE_GCODE_KEY])
-            and gcode.upper().startswith(SET_COLOR_GCODE)
-        ):
-            parameter_list = cmd.split(" ")[1:]
-            is_color_change = False
-            index, brightness = -1, -1
-            red, green, blue, white = 0, 0, 0, 0
-
-            for parameter in parameter_list:
-                parameter_key = parameter[0].upper()
-                parameter_value = int(parameter[1:])
-
-                if parameter_key == "I":
-                    index = parameter_value
-                elif parameter_key == "S":
-                    pass  # not supported
-                elif parameter_key == "P":
-                    brightness = parameter_value / 255.0
-                elif parameter_key == "R":
-                    red = parameter_value
-                    is_color_change = True
-                elif parameter_key == "U":
-                    green = parameter_value
-                    is_color_change = True
-                elif parameter_key == "B":
-                    blue = parameter_value
-                    is_color_change = True
-                elif parameter_key == "W":
-                    white = parameter_value
-                    is_color_change = True
-
-            if index >= 0 and is_color_change:
-                self._pixels[index] = (red, green, blue, white)
-            elif is_color_change:
-                self._pixels.fill((red, green, blue, white))
-
-            if brightness >= 0:
-                self._pixels.brightness = brightness
+    ##~~ Output worker operations, these only run on the output thread
+
+    def _create_pixels(
+        self,
+        pixel_pin: int,
+        num_pixels: int,
+        brightness: float,
+        pixel_order: str,
+        shared_memory: bool,
+        overflow_policy: str,
+        extra_strips: list,
+    ):
+        if self._api_process is not None and not self._api_ready.wait(API_READY_TIMEOUT):
+            self._logger.warning("NeoPixel api not ready after {} seconds, connecting anyway".format(API_READY_TIMEOUT))
+            # The delegates keep retrying, later re-inits don't hold up the output for it again.
+            self._api_ready.set()
+
+        strip_configs = [(pixel_pin, num_pixels, pixel_order)] + list(extra_strips)
+        for index in sorted(set(self._delegates) - set(range(len(strip_configs)))):
+            # A removed strip is turned off rather than left on its last frame.
+            layers = self._strips[index]
+            for layer in LAYERS[1:]:
+                layers[layer].clear()
+            layers[LAYER_BASE].fill((0, 0, 0, 0))
+            layers[LAYER_BASE].show()
+            delegate = self._delegates.pop(index)
+            # Otherwise the api keeps the strip, and restores it and its pin with its saved state.
+            delegate.release()
+            delegate.flush()
+            delegate.close()
+
+        self._strips = {}
+        for index, (strip_pin, strip_pixels, strip_order) in enumerate(strip_configs):
+            delegate = self._strip_delegate(index, shared_memory)
+            delegate.overflow_policy = overflow_policy
+            layers = {
+                LAYER_BASE: neopixel.NeoPixel(
+                    Pin(strip_pin),
+                    strip_pixels,
+                    brightness=brightness,
+                    auto_write=False,
+                    pixel_order=strip_order,
+                    delegate=delegate,
+                ),
+            }
+            for layer in LAYERS[1:]:
+                layers[layer] = neopixel.NeoPixel(
+                    Pin(strip_pin),
+                    strip_pixels,
+                    auto_write=False,
+                    pixel_order=strip_order,
+                    delegate=delegate,
+                    layer=layer,
+                )
+            self._strips[index] = layers
+        self._layers = self._strips[0]
+        self._pixels = self._layers[LAYER_BASE]
+
+        # demo(self._pixels)
+
+    def _strip_delegate(self, index: int, shared_memory: bool) -> SocketNeoPixelDelegate:
+        shared_frame_path = None
+        if shared_memory:
+            shared_frame_path = SHARED_FRAME_PATH if index == 0 else "{}.{}".format(SHARED_FRAME_PATH, index)
+        delegate = self._delegates.get(index)
+        # Keep each strip's connection to the api across re-inits, unless its transport changed.
+        if delegate is None or delegate.shared_frame_path != shared_frame_path:
+            if delegate is not None:
+                delegate.close()
+            delegate = self._delegates[index] = SocketNeoPixelDelegate(
+                SOCKET_SERVER_ADDRESS,
+                self._logger,
+                shared_frame_path=shared_frame_path,
+                strip=index,
+                metrics=self._metrics,
+            )
+        return delegate
+
+    def _strip_layer(self, layer: str, strip: int = 0) -> neopixel.NeoPixel:
+        return self._strips.get(strip, {}).get(layer)
+
+    def _flush_output(self) -> bool:
+        pending = False
+        for delegate in self._delegates.values():
+            if delegate.connected and delegate.flush():
+                pending = True
+        return pending
+
+    def _write_brightness(self, value: float, strip: int = None):
+        # Without a strip, e.g. from the UI, every strip follows the brightness.
+        for index, layers in self._strips.items():
+            if strip is None or index == strip:
+                layers[LAYER_BASE].brightness = value
+
+    def _write_fill(self, layer: str, color, strip: int = 0):
+        pixels = self._strip_layer(layer, strip)
+        if pixels is not None:
+            pixels.fill(color)
 
+    def _write_clear(self, layer: str):
+        pixels = self._strip_layer(layer)
+        if pixels is not None:
+            pixels.clear()
+
+    def _write_pixel(self, layer: str, index: int, color, strip: int = 0):
+        pixels = self._strip_layer(layer, strip)
+        if pixels is not None:
+            pixels[index] = color
+
+    def _write_frame(self, strip: int, start: int, frame: bytes):
+        pixels = self._strip_layer(LAYER_BASE, strip)
+        if pixels is not None:
+            pixels.write(start, frame)
+            pixels.show()
+
+    def _write_preset(self, layer: str, name: str, strip: int = 0):
+        pixels = self._strip_layer(layer, strip)
+        preset = self._presets.get(name)
+        if pixels is None or preset is None:
+            return
+        color, brightness = preset
+        # Rendered once per strip, the delegate only sends the frame when the api doesn't have it cached yet.
+        frame = self._preset_frames.get((strip, name))
+        if frame is None or len(frame) != len(pixels) * BYTES_PER_PIXEL:
+            frame = self._preset_frames[(strip, name)] = bytes(self._parse_color(color)) * len(pixels)
+        pixels.preset(name, frame, brightness)
+
+    def _write_idle(self, dim: bool):
+        for index, layers in self._strips.items():
+            pixels = layers[LAYER_BASE]
+            if dim:
+                self._undimmed[index] = pixels.brightness
+                pixels.brightness = min(pixels.brightness, float(self._config[IDLE_BRIGHTNESS_KEY]))
+            elif index in self._undimmed:
+                pixels.brightness = self._undimmed[index]
+            pixels.show()
+        if not dim:
+            self._undimmed = {}
+
+    def _write_effect(self, layer: str, name: str, params: dict):
+        pixels = self._strip_layer(layer)
+        if pixels is not None:
+            pixels.effect(name, **params)
+
+    def _write_progress(self, lit: int, color, reset: bool):
+        pixels = self._layers.get(LAYER_STATUS)
+        if pixels is not None:
+            if reset:
+                pixels.clear()
+            pixels[:lit] = [color] * lit
+            pixels.show()
+
+    def _write_temperature(self, start: int, stop: int, color):
+        pixels = self._layers.get(LAYER_TEMPERATURE)
+        if pixels is not None:
+            pixels[start:stop] = [color] * (stop - start)
+            pixels.show()
+
+    def _write_transition(self, layer: str, color, brightness: float, duration: float, strip: int = 0):
+        pixels = self._strip_layer(layer, strip)
+        if pixels is not None:
+            pixels.transition(color, brightness, duration)
+
+    def _write_show(self, layer: str, strip: int = 0):
+        pixels = self._strip_layer(layer, strip)
+        if pixels is not None:
+            pixels.show()
+
+    def _write_overflow_policy(self, overflow_policy: str):
+        for delegate in self._delegates.values():
+            delegate.overflow_policy = overflow_policy
+
+    def process_gcode(self, comm, phase, cmd: str, cmd_type, gcode, subcode, tags):
+        if self._watch_gcode and gcode in SET_COLOR_GCODES:
+            started = time.perf_counter()
+            self._queue_m150(cmd)
+            self._gcode_time.observe(time.perf_counter() - started)
             return None,
 
-        return
+        # Heating outside a print, e.g. from the terminal, has no print end to clear the status again.
+        if self._watch_status and gcode in HEATING_GCODES and self._printer.is_printing():
+            started = time.perf_counter()
+            self._show_status(STATUS_HEATING, HEATING_COLOR_KEY)
+            self._gcode_time.observe(time.perf_counter() - started)
+
+    def _queue_m150(self, cmd: str):
+        # Only enqueue here, this runs on the printer communication thread.
+        self._touch()
+        command = self._m150_index.get(cmd)
+        if command is None:
+            try:
+                command = parse_m150(cmd)
+            except ValueError as e:
+                self._logger.warning("Ignoring `{}`, {}".format(cmd, e))
+                return
+        index, color, brightness, duration, strip, preset = command
+
+        # M150 colors go to their own layer, above the UI color and print status.
+        # Every strip is written and shown on its own keys, so commands for one don't coalesce with another's.
+        if strip == 0:
+            self._covered_layers.add(LAYER_GCODE)
+        if preset is not None:
+            if preset >= len(self._preset_names):
+                self._logger.warning("Ignoring `{}`, there is no preset {}".format(cmd, preset))
+                return
+            self._output.submit(
+                ("fill", LAYER_GCODE, strip),
+                self._write_preset,
+                LAYER_GCODE,
+                self._preset_names[preset],
+                strip,
+            )
+            self._output.submit(("show", LAYER_GCODE, strip), self._write_show, LAYER_GCODE, strip)
+            return
+        if duration > 0 and index < 0 and (color is not None or brightness is not None):
+            # Like without D, P alone only changes the brightness and keeps the colors.
+            self._output.submit(
+                ("fill", LAYER_GCODE, strip) if color is not None else ("brightness", strip),
+                self._write_transition,
+                LAYER_GCODE,
+                color,
+                brightness,
+                duration,
+                strip,
+            )
+            return
+
+        if index >= 0 and color is not None:
+            self._output.submit(
+                ("pixel", LAYER_GCODE, strip, index),
+                self._write_pixel,
+                LAYER_GCODE,
+                index,
+                color,
+                strip,
+            )
+        elif color is not None:
+            self._output.submit(("fill", LAYER_GCODE, strip), self._write_fill, LAYER_GCODE, color, strip)
+
+        if brightness is not None:
+            self._output.submit(("brightness", strip), self._write_brightness, brightness, strip)
+
+        self._output.submit(("show", LAYER_GCODE, strip), self._write_show, LAYER_GCODE, strip)
+
+    def preprocess_gcode(self, path, file_object, links=None, printer_profile=None, allow_overwrite=False, *args, **kwargs):
+        if not octoprint.filemanager.valid_file_type(path, type="gcode"):
+            return file_object
+        return octoprint.filemanager.util.StreamWrapper(
+            file_object.filename,
+            M150IndexStream(file_object.stream(), self._m150_index_folder(), path, self._logger),
+        )
+
+    def _m150_index_folder(self):
+        return os.path.join(self.get_plugin_data_folder(), M150_INDEX_FOLDER)
+
+    def process_temperatures(self, comm, parsed_temperatures, *args, **kwargs):
+        # Runs on the comm thread for every report, so quantize here and only enqueue when a color changes.
+        if self._watch_temperature:
+            for sensor, (minimum, maximum) in TEMPERATURE_SENSORS.items():
+                reading = parsed_temperatures.get(sensor)
+                if reading is None or reading[0] is None:
+                    continue
+                quantizer = self._temperatures.get(sensor)
+                if quantizer is None:
+                    quantizer = self._temperatures[sensor] = TemperatureQuantizer(minimum, maximum)
+                if quantizer.update(reading[0]):
+                    self._show_temperature(sensor, TEMPERATURE_GRADIENT[quantizer.step])
+
+        return parsed_temperatures
+
+    def _show_temperature(self, sensor: str, color):
+        num_pixels = int(self._config[NUM_PIXELS_KEY])
+        index = list(TEMPERATURE_SENSORS).index(sensor)
+        start = index * num_pixels // len(TEMPERATURE_SENSORS)
+        stop = (index + 1) * num_pixels // len(TEMPERATURE_SENSORS)
+        self._covered_layers.add(LAYER_TEMPERATURE)
+        self._output.submit(("temperature", sensor), self._write_temperature, start, stop, color)
 
 
 # If you want your plugin to be registered within OctoPrint under a different name than what you defined in setup.py
@@ -326,4 +1059,6 @@ def __plugin_load__():
     __plugin_hooks__ = {
         "octoprint.plugin.softwareupdate.check_config": __plugin_implementation__.get_update_information,
         "octoprint.comm.protocol.gcode.sending": __plugin_implementation__.process_gcode,
+        "octoprint.comm.protocol.temperatures.received": __plugin_implementation__.process_temperatures,
+        "octoprint.filemanager.preprocessor": __plugin_implementation__.preprocess_gcode,
     }
@@ -0,0 +1,134 @@
+"""Animations rendered locally by the sock_api daemon.
+
+An effect is created with the strip length, the frame currently on the strip and
+its parameters, then asked for one frame at a time with the seconds elapsed since
+it started. ``render`` returns a frame built with the ``render`` module, or None
+to leave the layer as it is, and ``done`` turns true for effects that end on
+their own.
+
+Effects may also animate brightness by setting ``brightness`` on every frame,
+and ``final_brightness`` to what the strip should be left at when they end or
+are interrupted. Both stay ``None`` for effects that don't touch it.
+"""
+import math
+
+import render
+
+BLACK = (0, 0, 0, 0)
+
+
+def _color(value, default=BLACK):
+    if value is None:
+        return default
+    color = tuple(int(c) for c in value)
+    return color + (0,) * (4 - len(color))
+
+
+def wheel(pos: int):
+    # Input a value 0 to 255 to get a color value.
+    # The colours are a transition r - g - b - back to r.
+    pos &= 255
+    if pos < 85:
+        return pos * 3, 255 - pos * 3, 0, 0
+    if pos < 170:
+        pos -= 85
+        return 255 - pos * 3, 0, pos * 3, 0
+    pos -= 170
+    return 0, pos * 3, 255 - pos * 3, 0
+
+
+WHEEL = render.palette([wheel(pos) for pos in range(256)])
+
+
+class Effect:
+    def __init__(self, num_pixels: int, current, **params):
+        self.num_pixels = num_pixels
+        self.done = False
+        self.brightness: float = None
+        self.final_brightness: float = None
+
+    def render(self, elapsed: float):
+        raise NotImplementedError
+
+
+class Rainbow(Effect):
+    def __init__(self, num_pixels, current, speed: float = 0.25, **params):
+        super().__init__(num_pixels, current)
+        self.speed = float(speed)
+        self._offsets = render.index_array(i * 256 // max(num_pixels, 1) for i in range(num_pixels))
+
+    def render(self, elapsed):
+        return render.index_palette(WHEEL, self._offsets, int(elapsed * self.speed * 256))
+
+
+class Breathe(Effect):
+    def __init__(self, num_pixels, current, color=None, period: float = 4.0, minimum: float = 0.05, **params):
+        super().__init__(num_pixels, current)
+        self.frame = render.solid(num_pixels, _color(color, (255, 255, 255, 0)))
+        self.period = float(period)
+        self.minimum = float(minimum)
+
+    def render(self, elapsed):
+        level = self.minimum + (1 - self.minimum) * (1 - math.cos(2 * math.pi * elapsed / self.period)) / 2
+        return render.scale(self.frame, level)
+
+
+class Chase(Effect):
+    def __init__(self, num_pixels, current, color=None, background=None, speed: float = 10.0, length: int = 3, **params):
+        super().__init__(num_pixels, current)
+        self.color = _color(color, (255, 255, 255, 0))
+        self.background = render.solid(num_pixels, _color(background))
+        self.speed = float(speed)
+        self.length = int(length)
+
+    def render(self, elapsed):
+        head = int(elapsed * self.speed) % max(self.num_pixels, 1)
+        frame = render.copy_frame(self.background)
+        for i in range(min(self.length, self.num_pixels)):
+            render.set_pixel(frame, (head - i) % self.num_pixels, self.color)
+        return frame
+
+
+class Crossfade(Effect):
+    def __init__(
+        self,
+        num_pixels,
+        current,
+        color=None,
+        duration: float = 1.0,
+        brightness: float = None,
+        current_brightness: float = 1.0,
+        **params
+    ):
+        super().__init__(num_pixels, current)
+        self.start = render.copy_frame(current) if current is not None else render.new_frame(num_pixels)
+        # Without a color only the brightness fades, and the layer keeps whatever it shows.
+        self.end = render.solid(num_pixels, _color(color)) if color is not None else None
+        self.duration = max(float(duration), 0.001)
+        self.start_brightness = float(current_brightness)
+        if brightness is not None:
+            self.final_brightness = float(brightness)
+
+    def render(self, elapsed):
+        t = elapsed / self.duration
+        if t >= 1.0:
+            self.done = True
+            self.brightness = self.final_brightness
+            return self.end
+        if self.final_brightness is not None:
+            self.brightness = self.start_brightness + (self.final_brightness - self.start_brightness) * t
+        if self.end is None:
+            return None
+        return render.blend(self.start, self.end, t)
+
+
+EFFECTS = {
+    "rainbow": Rainbow,
+    "breathe": Breathe,
+    "chase": Chase,
+    "crossfade": Crossfade,
+}
+
+
+def create(name: str, num_pixels: int, current, params: dict, current_brightness: float = 1.0) -> Effect:
+    return EFFECTS[name](num_pixels, current, current_brightness=current_brightness, **params)
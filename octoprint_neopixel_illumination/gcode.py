@@ -0,0 +1,133 @@
+import collections
+import hashlib
+import json
+import logging
+import os
+import re
+
+from octoprint.filemanager.util import LineProcessorStream
+
+M150_PARAMETER_PATTERN = re.compile(r"([A-Za-z])\s*(\d+)")
+M150_LINE_PATTERN = re.compile(rb"^\s*M150\b", re.IGNORECASE)
+INDEX_VERSION = 3
+
+M150Command = collections.namedtuple("M150Command", ["index", "color", "brightness", "duration", "strip", "preset"])
+"""A parsed M150, index is -1 for the whole strip and color, brightness or preset are None when not set."""
+
+_COLOR_PARAMETERS = {"R": 0, "U": 1, "B": 2, "W": 3}
+
+
+def parse_m150(cmd: str) -> M150Command:
+    # M150 [B<intensity>] [D<milliseconds>] [I<pixel>] [P<intensity>] [R<intensity>] [S<strip>] [U<intensity>] [W<intensity>]
+    # M150 B100 R255 U50 W0
+    # D is an extension: fade the whole strip to the color and brightness over that many milliseconds, to the
+    # brightness alone without a color.
+    # Q is an extension: show the preset at that position in the plugin settings.
+    index, brightness, duration, strip, preset = -1, None, 0.0, 0, None
+    color = None
+
+    # The first match is the M150 command itself.
+    for parameter_key, parameter_value in M150_PARAMETER_PATTERN.findall(cmd)[1:]:
+        parameter_key = parameter_key.upper()
+        parameter_value = int(parameter_value)
+
+        if parameter_key == "I":
+            index = parameter_value
+        elif parameter_key == "S":
+            strip = parameter_value
+        elif parameter_key == "D":
+            duration = parameter_value / 1000.0
+        elif parameter_key == "Q":
+            preset = parameter_value
+        elif parameter_key == "P":
+            if parameter_value > 255:
+                raise ValueError("P{} is out of range".format(parameter_value))
+            brightness = parameter_value / 255.0
+        elif parameter_key in _COLOR_PARAMETERS:
+            if parameter_value > 255:
+                raise ValueError("{}{} is out of range".format(parameter_key, parameter_value))
+            if color is None:
+                color = [0, 0, 0, 0]
+            color[_COLOR_PARAMETERS[parameter_key]] = parameter_value
+
+    return M150Command(index, tuple(color) if color is not None else None, brightness, duration, strip, preset)
+
+
+def normalize(line: str) -> str:
+    """Return a G-code line the way OctoPrint sends it, without comment or surrounding whitespace."""
+    return line.split(";", 1)[0].strip()
+
+
+def index_path(folder: str, path: str) -> str:
+    return os.path.join(folder, hashlib.sha1(path.encode()).hexdigest() + ".json")
+
+
+def load_index(folder: str, path: str) -> dict:
+    """Load the M150 index of a printed file, keyed by the command as it is sent."""
+    try:
+        with open(index_path(folder, path)) as index_file:
+            index = json.load(index_file)
+    except (OSError, ValueError):
+        return {}
+    if index.get("version") != INDEX_VERSION or index.get("path") != path:
+        return {}
+    return {
+        cmd: M150Command(command[0], tuple(command[1]) if command[1] is not None else None, *command[2:])
+        for cmd, command in index["commands"].items()
+    }
+
+
+def remove_index(folder: str, path: str):
+    try:
+        os.unlink(index_path(folder, path))
+    except FileNotFoundError:
+        pass
+
+
+class M150IndexStream(LineProcessorStream):
+    """Passes an upload through unchanged while indexing its M150 commands.
+
+    Every distinct M150 is parsed and validated once, and the results are saved
+    next to the other plugin data when the upload has been read to the end, so
+    printing the file only has to look them up.
+    """
+
+    def __init__(self, input_stream, folder: str, path: str, logger: logging.Logger):
+        super().__init__(input_stream)
+        self._folder = folder
+        self._path = path
+        self._logger = logger
+        self._commands = {}
+        self._line_number = 0
+        self._saved = False
+
+    def process_line(self, line):
+        self._line_number += 1
+        if M150_LINE_PATTERN.match(line):
+            cmd = normalize(line.decode("utf-8", "replace"))
+            if cmd not in self._commands:
+                try:
+                    self._commands[cmd] = parse_m150(cmd)
+                except ValueError as e:
+                    self._logger.warning("{} line {}: invalid `{}`, {}".format(self._path, self._line_number, cmd, e))
+                    self._commands[cmd] = None
+        return line
+
+    def read(self, n=-1):
+        # OctoPrint saves uploads with shutil.copyfileobj, which only ever calls read, readinto goes through here too.
+        data = super().read(n)
+        if (n < 0 or (n and not data)) and not self._saved:
+            self._saved = True
+            self._save()
+        return data
+
+    def _save(self):
+        commands = {cmd: command for cmd, command in self._commands.items() if command is not None}
+        if not commands:
+            remove_index(self._folder, self._path)
+            return
+
+        os.makedirs(self._folder, exist_ok=True)
+        with open(index_path(self._folder, self._path), "w") as index_file:
+            json.dump({"version": INDEX_VERSION, "path": self._path, "commands": commands}, index_file)
+        self._logger.info("Indexed {} M150 commands in {}".format(len(commands), self._path))
@@ -0,0 +1,117 @@
+"""Low overhead counters and latency histograms for the plugin and the sock_api daemon.
+
+A ``Histogram`` counts observations into fixed buckets, so recording one is a
+bisect and an increment whatever has been recorded before. A ``Meter`` counts
+events, like bytes or frames, and keeps one slot per second of its window to
+report a recent rate next to the total. Both are meant to have a single writing
+thread and can be read from any other, a reading is a snapshot that may be a
+single event behind.
+
+Each side keeps its instruments in a ``Metrics`` registry, the plugin serves its
+snapshot from its API and the daemon replies with its own to a ``stats`` command.
+"""
+import bisect
+import time
+
+LATENCY_BUCKETS = (
+    0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0,
+)
+"""Upper bounds in seconds of the latency buckets, slower observations go to a last, unbounded bucket."""
+QUANTILES = (0.5, 0.9, 0.99)
+RATE_WINDOW = 10
+"""Seconds a meter's rate is averaged over."""
+
+
+class Histogram:
+    def __init__(self, bounds: tuple = LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the ``q`` quantile, None when it is the unbounded one or nothing was observed."""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen and seen >= rank:
+                return bound
+        return None
+
+    def snapshot(self) -> dict:
+        snapshot = {
+            "count": self.count,
+            "sum": self.sum,
+            "bounds": list(self.bounds),
+            "counts": list(self.counts),
+        }
+        for q in QUANTILES:
+            snapshot["p{:g}".format(q * 100)] = self.quantile(q)
+        return snapshot
+
+
+class Meter:
+    def __init__(self, window: int = RATE_WINDOW):
+        self.total = 0
+        self._window = window
+        # Events per second, the slot of second s being s % len(slots), up to and including the second of the last
+        # mark. One slot more than the window, so that besides the current second the whole window is kept.
+        self._slots = [0] * (window + 1)
+        self._second = 0
+
+    def mark(self, count: int = 1):
+        second = int(time.monotonic())
+        if second != self._second:
+            # Clear the slots of the seconds that passed without a mark, they still hold counts from a window ago.
+            size = len(self._slots)
+            for passed in range(max(self._second + 1, second - size + 1), second + 1):
+                self._slots[passed % size] = 0
+            self._second = second
+        self._slots[second % len(self._slots)] += count
+        self.total += count
+
+    def rate(self) -> float:
+        """Events per second over the last ``window`` whole seconds."""
+        second = int(time.monotonic())
+        size = len(self._slots)
+        # Only seconds up to the last mark and no older than the slots reach back from it hold their own count.
+        oldest = max(second - self._window, self._second - size + 1)
+        newest = min(second, self._second + 1)
+        return sum(self._slots[s % size] for s in range(oldest, newest)) / self._window
+
+    def snapshot(self) -> dict:
+        return {"total": self.total, "rate": self.rate()}
+
+
+class Metrics:
+    """Instruments by name, created on first use."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self._histograms = {}
+        self._meters = {}
+
+    def histogram(self, name: str, bounds: tuple = LATENCY_BUCKETS) -> Histogram:
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            histogram = self._histograms[name] = Histogram(bounds)
+        return histogram
+
+    def meter(self, name: str) -> Meter:
+        meter = self._meters.get(name)
+        if meter is None:
+            meter = self._meters[name] = Meter()
+        return meter
+
+    def snapshot(self) -> dict:
+        return {
+            "uptime": time.monotonic() - self.started,
+            "histograms": {name: histogram.snapshot() for name, histogram in self._histograms.items()},
+            "meters": {name: meter.snapshot() for name, meter in self._meters.items()},
+        }
@@ -1,12 +1,24 @@
+import collections
 import http.client
 import json
 import logging
+import select
 import socket
 import time
 from typing import Tuple, Union, Sequence
 
 from .microcontroller import Pin
 
+# This module, and the protocol, sharedframe, render, effects and metrics modules, are imported both as part of the
+# plugin package and as top level modules by sock_api.py, so those modules must not use package relative imports.
+try:
+    from .. import protocol, sharedframe
+    from ..metrics import Metrics
+except ImportError:
+    import protocol
+    import sharedframe
+    from metrics import Metrics
+
 ColorUnion = Union[int, Tuple[int, int, int], Tuple[int, int, int, int]]
 
 RGB = "RGB"
@@ -18,11 +30,48 @@ RGBW = "RGBW"
 GRBW = "GRBW"
 """Green Red Blue White"""
 
+RECONNECT_DELAY_MIN = 0.5
+RECONNECT_DELAY_MAX = 30.0
+
+OVERFLOW_BLOCK = "block"
+"""Wait up to the send timeout for the socket to drain, then drop like drop_oldest"""
+OVERFLOW_COALESCE = "coalesce"
+"""Replace frames still waiting to be sent with one full frame"""
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+"""Drop the oldest waiting frames once the send buffer is full"""
+OVERFLOW_POLICIES = [OVERFLOW_COALESCE, OVERFLOW_DROP_OLDEST, OVERFLOW_BLOCK]
+
+SEND_BUFFER_SIZE = 64 * 1024
+SEND_TIMEOUT = 0.1
+STATS_TIMEOUT = 1.0
+
+TRANSITION_EFFECT = "crossfade"
+"""Daemon effect that renders transitions"""
+
 
 def get_logger():
     return logging.getLogger("octoprint.plugins.neopixel_illumination.api.neopixel")
 
 
+def request_stats(server_address: str, timeout: float = STATS_TIMEOUT) -> dict:
+    """Ask sock_api for its counters, on a short-lived connection so the reply never mixes with pixel commands."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        client.connect(server_address)
+        client.sendall(protocol.JsonEncoder().stats())
+        reply = bytearray()
+        while not reply.endswith(b"\n"):
+            data = client.recv(4096)
+            if not data:
+                break
+            reply += data
+    return json.loads(reply)["stats"]
+
+
+def transition_params(color: tuple, brightness: float, duration: float) -> dict:
+    return {"color": color, "brightness": brightness, "duration": duration}
+
+
 class NeoPixelDelegate:
     def __init__(self, logger: logging.Logger):
         self._logger = logger
@@ -39,6 +88,28 @@ class NeoPixelDelegate:
     def set_item(self, index: int, r: int, g: int, b: int, w: int):
         pass
 
+    def set_frame(self, start: int, data: bytes):
+        pass
+
+    def effect(self, name: str, params: dict):
+        pass
+
+    def transition(self, color: tuple, brightness: float, duration: float):
+        # Without a color only the brightness fades.
+        pass
+
+    def select_layer(self, name: str, blend: str):
+        pass
+
+    def clear_layer(self, name: str):
+        pass
+
+    def preset(self, name: str, data: bytes, brightness: float):
+        # Without a preset cache on the other end, the frame is sent every time.
+        self.set_frame(0, data)
+        if brightness is not None:
+            self.set_brightness(brightness)
+
     def get_item(self, index: int):
         pass
 
@@ -48,6 +119,13 @@ class NeoPixelDelegate:
     def get_brightness(self):
         pass
 
+    def release(self):
+        # The strip was removed, its backend can forget it.
+        pass
+
+    def close(self):
+        pass
+
 
 class LoggingNeoPixelDelegate(NeoPixelDelegate):
     def init(self, config):
@@ -62,6 +140,21 @@ class LoggingNeoPixelDelegate(NeoPixelDelegate):
     def set_item(self, index: int, r: int, g: int, b: int, w: int):
         self._logger.info(f"set {index} {r, g, b, w}")
 
+    def set_frame(self, start: int, data: bytes):
+        self._logger.info(f"frame {start} {data.hex()}")
+
+    def effect(self, name: str, params: dict):
+        self._logger.info(f"effect {name} {json.dumps(params)}")
+
+    def transition(self, color: tuple, brightness: float, duration: float):
+        self._logger.info(f"transition {color} {brightness} {duration}")
+
+    def clear_layer(self, name: str):
+        self._logger.info(f"clear layer {name}")
+
+    def preset(self, name: str, data: bytes, brightness: float):
+        self._logger.info(f"preset {name} {brightness}")
+
     def get_item(self, index: int):
         self._logger.info(f"get")
 
@@ -115,6 +208,15 @@ class HttpNeoPixelDelegate(NeoPixelDelegate):
     def set_item(self, index: int, r: int, g: int, b: int, w: int):
         self._get(f"/pixel/{index}/{r},{g},{b},{w}")
 
+    def set_frame(self, start: int, data: bytes):
+        self._post(f"/frame/{start}", data, {"Content-type": "application/octet-stream"})
+
+    def effect(self, name: str, params: dict):
+        self._post(f"/effect/{name}", json.dumps(params), self.JSON_HEADERS)
+
+    def transition(self, color: tuple, brightness: float, duration: float):
+        self.effect(TRANSITION_EFFECT, transition_params(color, brightness, duration))
+
     def get_item(self, index: int):
         self._get(f"/pixel/{index}")
 
@@ -125,36 +227,440 @@ class HttpNeoPixelDelegate(NeoPixelDelegate):
         self._get(f"/brightness")
 
 
+class LayerShadow:
+    """Plugin side copy of one strip layer, kept to replay it on a new connection."""
+
+    def __init__(self, num_pixels: int, blend: str, covered: bool = False):
+        self.blend = blend
+        self.frame = bytearray(num_pixels * protocol.BYTES_PER_PIXEL)
+        self.mask = bytearray(b"\x01" * num_pixels if covered else num_pixels)
+
+    def cover(self, start: int, stop: int):
+        stop = min(stop, len(self.mask))
+        self.mask[start:stop] = b"\x01" * (stop - start)
+
+    def clear(self):
+        self.frame[:] = bytes(len(self.frame))
+        self.mask[:] = bytes(len(self.mask))
+
+    def spans(self):
+        """Yield the ``(start, stop)`` pixel runs this layer covers."""
+        start = self.mask.find(1)
+        while start >= 0:
+            stop = self.mask.find(0, start)
+            if stop < 0:
+                stop = len(self.mask)
+            yield start, stop
+            start = self.mask.find(1, stop)
+
+
 class SocketNeoPixelDelegate(NeoPixelDelegate):
-    def __init__(self, server_address, logger):
+    """Sends pixel commands to sock_api over a single, self-healing connection.
+
+    The connection is opened lazily and reopened with exponential backoff when it
+    fails. The delegate remembers the strip config, brightness, frames and effects,
+    and replays them on every new connection, so a restarted sock_api picks up
+    where the old one left off. Each delegate drives the strip numbered
+    ``strip`` in sock_api, so every strip needs a delegate of its own. State is
+    kept per layer: writes go to the layer last selected with ``select_layer``,
+    and only the pixels a layer covers are replayed.
+
+    Writes never block on a full socket. Messages wait in an outgoing queue and
+    partially written messages resume where they stopped. When more than
+    ``buffer_size`` bytes are waiting, ``overflow_policy`` decides which frames
+    are given up. The layers that lost a frame are sent in full with the next
+    frame, or once the queue drains if no frame follows, so the strip always
+    converges on the latest state.
+
+    Messages, frames and bytes sent, frames dropped or coalesced and reconnects
+    are counted by meters in ``metrics``, which delegates can share.
+    """
+
+    def __init__(
+        self,
+        server_address,
+        logger,
+        protocol_name: str = protocol.PROTOCOL_BINARY,
+        shared_frame_path: str = None,
+        overflow_policy: str = OVERFLOW_COALESCE,
+        buffer_size: int = SEND_BUFFER_SIZE,
+        send_timeout: float = SEND_TIMEOUT,
+        strip: int = 0,
+        metrics: Metrics = None,
+    ):
         super().__init__(logger)
-        self._client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server_address = server_address
+        self.strip = strip
+        self.shared_frame_path = shared_frame_path
+        self.overflow_policy = overflow_policy
+        self.buffer_size = buffer_size
+        self.send_timeout = send_timeout
+        self._protocol_name = protocol_name
+        self._encoder = protocol.JsonEncoder()
+        self._shared_frame: sharedframe.SharedFrameBuffer = None
+        self._client: socket.socket = None
+        self._reconnect_delay = RECONNECT_DELAY_MIN
+        self._next_connect = 0.0
+        self._connected_before = False
+
+        metrics = metrics or Metrics()
+        self._messages = metrics.meter("messages")
+        self._frames = metrics.meter("frames")
+        self._bytes_sent = metrics.meter("bytes_sent")
+        self._frames_dropped = metrics.meter("frames_dropped")
+        self._frames_coalesced = metrics.meter("frames_coalesced")
+        self._reconnects = metrics.meter("reconnects")
+
+        # Entries are [layer of a droppable frame or None, unsent bytes].
+        self._outgoing = collections.deque()
+        self._outgoing_size = 0
+        # Layers that lost a frame and must be sent in full, and whether a show went out without them.
+        self._resync = set()
+        self._resync_show = False
+
+        # Last known state, replayed after connecting.
+        self._config: dict = None
+        self._brightness: float = None
+        self._layers = {}
+        self._layer = protocol.LAYER_BASE
+        self._shadow: LayerShadow = None
+        # Effects by the layer they run on.
+        self._effects = {}
+        # Mirrors the daemon's preset cache for this connection, in the same least recently used order.
+        self._presets = collections.OrderedDict()
+
+    @property
+    def connected(self) -> bool:
+        return self._client is not None
+
+    def connect(self) -> bool:
+        if self._client is not None:
+            return True
+        if time.monotonic() < self._next_connect:
+            return False
+
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         try:
-            self._client.connect(server_address)
-        except ConnectionRefusedError:
-            self._logger.error("Connection refused: {}".format(server_address))
+            client.connect(self.server_address)
+            self._encoder = self._negotiate(client)
+        except OSError as e:
+            client.close()
+            self._schedule_reconnect(e)
+            return False
+
+        client.setblocking(False)
+        self._client = client
+        self._reconnect_delay = RECONNECT_DELAY_MIN
+        if self._connected_before:
+            self._reconnects.mark()
+        self._connected_before = True
+        self._logger.info("Connected to {} using {} protocol".format(self.server_address, self._encoder.protocol))
+        self._replay()
+        return self._client is not None
+
+    def release(self):
+        # Named by index, a connection that never sent an init is bound to strip 0.
+        self._config = None
+        if self.connect():
+            self._write(self._encoder.release(self.strip))
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+        self._outgoing.clear()
+        self._outgoing_size = 0
+        if self._shared_frame is not None:
+            self._shared_frame.close()
+            self._shared_frame = None
+
+    def _schedule_reconnect(self, error: Exception):
+        self._next_connect = time.monotonic() + self._reconnect_delay
+        self._logger.error("{}: {}, retrying in {:.1f}s".format(self.server_address, error, self._reconnect_delay))
+        self._reconnect_delay = min(self._reconnect_delay * 2, RECONNECT_DELAY_MAX)
+
+    def _negotiate(self, client: socket.socket):
+        if self._protocol_name == protocol.PROTOCOL_JSON:
+            return protocol.JsonEncoder()
+
+        client.settimeout(protocol.HANDSHAKE_TIMEOUT)
+        try:
+            client.send(protocol.hello(self._protocol_name))
+            reply = client.recv(64)
+            if reply == protocol.hello(self._protocol_name):
+                return protocol.ENCODERS[self._protocol_name]()
+        except socket.timeout:
+            pass
+        finally:
+            client.settimeout(None)
+
+        return protocol.JsonEncoder()
+
+    def _replay(self):
+        if self._config is None:
+            return
+
+        # An init leaves the connection on the base layer with the other layers cleared, and no presets.
+        self._presets.clear()
+        self._write(self._encoder.init(self._config))
+        if self.shared_frame_path:
+            self._attach_shared_frame(self._config["n"])
+        if self._brightness is not None:
+            self._write(self._encoder.set_brightness(self._brightness))
+        self._resync.clear()
+        self._resync_show = False
+        for name in self._layers:
+            self._write_layer(name)
+        for layer, (name, params) in self._effects.items():
+            self._write(self._encoder.select_layer(layer, self._layers[layer].blend))
+            self._write(self._encoder.effect(name, params))
+        self._write(self._encoder.select_layer(self._layer, self._shadow.blend))
+        self._write(self._encoder.show())
+
+    def _write_layer(self, name: str):
+        """Select layer ``name`` and send every pixel it covers, leaving it selected."""
+        shadow = self._layers[name]
+        self._write(self._encoder.select_layer(name, shadow.blend))
+        for start, stop in shadow.spans():
+            bpp = protocol.BYTES_PER_PIXEL
+            self._write_span(name, start, bytes(shadow.frame[start * bpp:stop * bpp]))
+
+    def _send(self, message: bytes):
+        if self._client is None:
+            # A new connection replays the current state, which already includes this message.
+            self.connect()
+            return
+        self._write(message)
+
+    def _write(self, message: bytes, frame_layer: str = None):
+        if self._client is None:
+            return
+        self._outgoing.append([frame_layer, memoryview(message)])
+        self._outgoing_size += len(message)
+        self._messages.mark()
+        if frame_layer is not None:
+            self._frames.mark()
+        if self.flush() and self._outgoing_size > self.buffer_size:
+            self._overflow()
+
+    def flush(self) -> bool:
+        """Write as much queued output as the socket accepts, return True if some is left."""
+        while self._outgoing:
+            entry = self._outgoing[0]
+            try:
+                sent = self._client.send(entry[1])
+            except BlockingIOError:
+                break
+            except OSError as e:
+                self.close()
+                self._schedule_reconnect(e)
+                return False
+
+            self._outgoing_size -= sent
+            self._bytes_sent.mark(sent)
+            if sent < len(entry[1]):
+                # Partially written, the rest must follow before anything else.
+                entry[0] = None
+                entry[1] = entry[1][sent:]
+                break
+            self._outgoing.popleft()
+
+        if not self._outgoing and self._resync:
+            # Frames were dropped and no frame followed to bring their layers along, send them now.
+            shown = self._resync_show
+            self._write_resync()
+            if shown:
+                self._write(self._encoder.show())
+        return bool(self._outgoing)
+
+    def _overflow(self):
+        if self.overflow_policy == OVERFLOW_BLOCK:
+            deadline = time.monotonic() + self.send_timeout
+            while self._outgoing_size > self.buffer_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                select.select([], [self._client], [], remaining)
+                if not self.flush():
+                    return
+
+        self._frames_dropped.mark(self._drop_frames(self.buffer_size))
+
+    def _drop_frames(self, limit: int = 0) -> int:
+        """Drop waiting frames, oldest first, until at most ``limit`` bytes are queued, return how many."""
+        dropped = 0
+        show = self._encoder.show()
+        kept = collections.deque()
+        for entry in self._outgoing:
+            if entry[0] is not None and self._outgoing_size > limit:
+                self._outgoing_size -= len(entry[1])
+                self._resync.add(entry[0])
+                dropped += 1
+            else:
+                if dropped and entry[1] == show:
+                    self._resync_show = True
+                kept.append(entry)
+        self._outgoing = kept
+
+        if dropped:
+            if self._logger.isEnabledFor(logging.DEBUG):
+                self._logger.debug("Dropped {} frames".format(dropped))
+        return dropped
+
+    def _write_frame(self, start: int, data: bytes):
+        if self.overflow_policy == OVERFLOW_COALESCE and self._outgoing:
+            self._frames_coalesced.mark(self._drop_frames())
+        if self._resync and self._write_resync():
+            # Frames were dropped, the layer was sent in full rather than just this span.
+            return
+
+        self._write_span(self._layer, start, data)
+
+    def _write_resync(self) -> bool:
+        """Send the layers that lost frames in full leaving the current layer selected, return whether it was one."""
+        resync, self._resync = self._resync, set()
+        # Showing is up to whoever writes next again.
+        self._resync_show = False
+        # The current layer goes last, so it is left selected.
+        for name in sorted(resync, key=lambda name: name == self._layer):
+            self._write_layer(name)
+        if self._layer in resync:
+            return True
+        self._write(self._encoder.select_layer(self._layer, self._shadow.blend))
+        return False
+
+    def _write_span(self, layer: str, start: int, data: bytes):
+        if self._shared_frame is not None:
+            slot = self._shared_frame.write(start, data, protocol.LAYERS.index(layer))
+            self._write(self._encoder.frame_ready(slot, start, len(data) // protocol.BYTES_PER_PIXEL), layer)
+        else:
+            self._write(self._encoder.set_frame(start, data), layer)
 
-    def _send(self, data: dict):
-        message = json.dumps(data)
+    def _attach_shared_frame(self, num_pixels: int):
+        if self._shared_frame is not None:
+            self._shared_frame.close()
+            self._shared_frame = None
         try:
-            self._client.send(message.encode() + b"\n")
-        except (BrokenPipeError, OSError) as e:
-            self._logger.error("{}: {}".format(e, self._client))
+            self._shared_frame = sharedframe.SharedFrameBuffer(
+                self.shared_frame_path, num_pixels, protocol.BYTES_PER_PIXEL, create=True, regions=len(protocol.LAYERS)
+            )
+        except OSError as e:
+            self._logger.error("Shared frame unavailable, sending frames over the socket: {}".format(e))
+            return
+        self._write(self._encoder.shared_frame(self.shared_frame_path, num_pixels))
 
     def init(self, config: dict):
-        self._send({"init": config})
+        # The daemon drives several strips, the init tells it which one this connection is for.
+        self._config = dict(config, strip=self.strip)
+        self._shadow = LayerShadow(config["n"], protocol.BLEND_NORMAL, covered=True)
+        self._layers = {protocol.LAYER_BASE: self._shadow}
+        self._layer = protocol.LAYER_BASE
+        self._brightness = config.get("brightness")
+        self._effects = {}
+        self._presets.clear()
+        if self._client is None:
+            self.connect()
+            return
+        self._write(self._encoder.init(self._config))
+        if self.shared_frame_path:
+            self._attach_shared_frame(config["n"])
 
     def show(self):
-        self._send({"show": ""})
+        self._send(self._encoder.show())
+
+    def _fill_shadow(self, r: int, g: int, b: int, w: int):
+        shadow = self._shadow
+        shadow.frame[:] = bytes((r, g, b, w)) * len(shadow.mask)
+        shadow.cover(0, len(shadow.mask))
+        self._stop_effect(self._layer)
+
+    def _stop_effect(self, layer: str):
+        self._effects.pop(layer, None)
 
     def fill(self, r: int, g: int, b: int, w: int):
-        self._send({"fill": (r, g, b, w)})
+        self._fill_shadow(r, g, b, w)
+        self._send(self._encoder.fill(r, g, b, w))
 
     def set_item(self, index: int, r: int, g: int, b: int, w: int):
-        self._send({"pixel": [index, (r, g, b, w)]})
+        offset = index * protocol.BYTES_PER_PIXEL
+        self._shadow.frame[offset:offset + protocol.BYTES_PER_PIXEL] = bytes((r, g, b, w))
+        self._shadow.cover(index, index + 1)
+        self._stop_effect(self._layer)
+        self._send(self._encoder.set_item(index, r, g, b, w))
+
+    def set_frame(self, start: int, data: bytes):
+        offset = start * protocol.BYTES_PER_PIXEL
+        self._shadow.frame[offset:offset + len(data)] = data
+        self._shadow.cover(start, start + len(data) // protocol.BYTES_PER_PIXEL)
+        self._stop_effect(self._layer)
+        if self._client is None:
+            self.connect()
+            return
+        self._write_frame(start, data)
+
+    def effect(self, name: str, params: dict):
+        if name:
+            self._effects[self._layer] = (name, params)
+        else:
+            self._stop_effect(self._layer)
+        self._send(self._encoder.effect(name, params))
+
+    def transition(self, color: tuple, brightness: float, duration: float):
+        # The api interpolates, the replay state jumps straight to where the transition ends.
+        if color is not None:
+            self._fill_shadow(*color)
+        else:
+            # The layer keeps its pixels, but like any transition this replaces its effect.
+            self._stop_effect(self._layer)
+        if brightness is not None:
+            self._brightness = brightness
+        self._send(self._encoder.effect(TRANSITION_EFFECT, transition_params(color, brightness, duration)))
+
+    def preset(self, name: str, data: bytes, brightness: float):
+        shadow = self._shadow
+        shadow.frame[:] = data
+        shadow.cover(0, len(shadow.mask))
+        self._stop_effect(self._layer)
+        if brightness is not None:
+            self._brightness = brightness
+        if self._client is None:
+            self.connect()
+            return
+
+        # Only define the preset when the daemon doesn't hold this rendering of it, then it's a few bytes to switch.
+        cached = self._presets.pop(name, None)
+        if cached != (data, brightness):
+            if len(self._presets) >= protocol.PRESET_CACHE_SIZE:
+                self._presets.popitem(last=False)
+            self._write(self._encoder.define_preset(name, brightness, data))
+        self._presets[name] = (data, brightness)
+        self._write(self._encoder.preset(name))
+
+    def select_layer(self, name: str, blend: str):
+        if name == self._layer:
+            return
+        shadow = self._layers.get(name)
+        if shadow is None:
+            shadow = self._layers[name] = LayerShadow(len(self._shadow.mask), blend)
+        shadow.blend = blend
+        self._layer = name
+        self._shadow = shadow
+        self._send(self._encoder.select_layer(name, blend))
+
+    def clear_layer(self, name: str):
+        shadow = self._layers.get(name)
+        if shadow is None or (name != protocol.LAYER_BASE and shadow.mask.find(1) < 0):
+            # Nothing to clear, don't send anything.
+            return
+        shadow.clear()
+        if name == protocol.LAYER_BASE:
+            shadow.cover(0, len(shadow.mask))
+        self._stop_effect(name)
+        self._send(self._encoder.clear_layer(name))
 
     def set_brightness(self, brightness: float):
-        self._send({"brightness": brightness})
+        self._brightness = brightness
+        self._send(self._encoder.set_brightness(brightness))
 
 
 class NeoPixel:
@@ -168,10 +674,13 @@ class NeoPixel:
         auto_write: bool = True,
         pixel_order: str = None,
         delegate: NeoPixelDelegate = None,
+        layer: str = None,
+        blend: str = protocol.BLEND_NORMAL,
     ):
-        self._pin = pin
+        # Like the hardware driver, the pixel order decides how many bytes a pixel is.
+        self.pin = pin
         self._pixels = n
-        self._bpp = bpp
+        self._bpp = len(pixel_order) if pixel_order else bpp
         self._brightness = brightness
         self._auto_write = auto_write
         self._pixel_order = pixel_order
@@ -183,17 +692,26 @@ class NeoPixel:
             "pixel_order": pixel_order,
         }
 
-        self._pixel_buffer = [(0, 0, 0, 0) for _ in range(n)]
+        # Shadow of the strip, one RGBW byte quad per pixel. Writes are served
+        # from here and only the dirty span [start, stop) is sent on show().
+        self._pixel_buffer = bytearray(n * protocol.BYTES_PER_PIXEL)
+        self._dirty_start = n
+        self._dirty_stop = 0
+
+        # Not part of the NeoPixel API: a layer shares the delegate of an
+        # already initialized strip and is composited over its base layer.
+        self._layer = layer or protocol.LAYER_BASE
+        self._blend = blend
 
         self._delegate: NeoPixelDelegate = delegate or LoggingNeoPixelDelegate(get_logger())
-        self._delegate.init(self._config)
+        if layer is None:
+            self._delegate.init(self._config)
 
     def __repr__(self):
         return "[" + ", ".join([str(x) for x in self]) + "]"
 
     @property
     def brightness(self):
-        self._delegate.get_brightness()
         return self._brightness
 
     @brightness.setter
@@ -201,47 +719,145 @@ class NeoPixel:
         self._brightness = value
         self._delegate.set_brightness(value)
 
+    def _mark_dirty(self, start: int, stop: int):
+        if start < self._dirty_start:
+            self._dirty_start = start
+        if stop > self._dirty_stop:
+            self._dirty_stop = stop
+
+    def _clear_dirty(self):
+        self._dirty_start = self._pixels
+        self._dirty_stop = 0
+
+    def _select(self):
+        self._delegate.select_layer(self._layer, self._blend)
+
     def show(self):
+        # Pixel writes are staged locally and committed as a single frame.
+        self._select()
+        if self._dirty_start < self._dirty_stop:
+            bpp = protocol.BYTES_PER_PIXEL
+            self._delegate.set_frame(
+                self._dirty_start,
+                bytes(self._pixel_buffer[self._dirty_start * bpp:self._dirty_stop * bpp]),
+            )
+            self._clear_dirty()
         self._delegate.show()
 
     def fill(self, color: ColorUnion):
-        r, g, b, w = color
+        r, g, b, w = self._rgbw(color)
+        # A fill supersedes any staged pixel writes.
+        self._pixel_buffer[:] = bytes((r, g, b, w)) * self._pixels
+        self._clear_dirty()
+        self._select()
         self._delegate.fill(r, g, b, w)
-        # for i in range(self._pixels):
-        #     self._set_item(i, r, g, b, w)
-        # if self._auto_write:
-        #     self.show()
+
+    def clear(self):
+        # Not part of the NeoPixel API: uncovers the layer so the ones below show through.
+        self._pixel_buffer[:] = bytes(len(self._pixel_buffer))
+        self._clear_dirty()
+        self._delegate.clear_layer(self._layer)
+
+    def effect(self, name: str, **params):
+        # Not part of the NeoPixel API: the effect is rendered by the delegate's backend.
+        self._select()
+        self._delegate.effect(name, params)
+
+    def transition(self, color: ColorUnion, brightness: float = None, duration: float = 1.0):
+        # Not part of the NeoPixel API: fades to a fill color, and optionally a brightness, over ``duration`` seconds.
+        # Without a color only the brightness fades.
+        if color is not None:
+            color = self._rgbw(color)
+            self._pixel_buffer[:] = bytes(color) * self._pixels
+            self._clear_dirty()
+        if brightness is not None:
+            self._brightness = brightness
+        self._select()
+        self._delegate.transition(color, brightness, duration)
+
+    def deinit(self):
+        # Blanks the strip and releases the pin.
+        self.fill((0, 0, 0, 0))
+        self.show()
+        self._delegate.close()
+
+    def write(self, start: int, data: bytes):
+        # Not part of the NeoPixel API: copies packed RGBW bytes into the strip from pixel ``start`` on.
+        bpp = protocol.BYTES_PER_PIXEL
+        stop = start + len(data) // bpp
+        if start < 0 or stop > self._pixels:
+            raise IndexError
+        self._pixel_buffer[start * bpp:stop * bpp] = data
+        self._mark_dirty(start, stop)
+        if self._auto_write:
+            self.show()
+
+    def preset(self, name: str, data: bytes, brightness: float = None):
+        # Not part of the NeoPixel API: shows a frame rendered ahead of time, which the delegate may cache by name.
+        self._pixel_buffer[:] = data
+        self._clear_dirty()
+        if brightness is not None:
+            self._brightness = brightness
+        self._select()
+        self._delegate.preset(name, data, brightness)
 
     def __len__(self):
         return self._pixels
 
+    @staticmethod
+    def _rgbw(color: ColorUnion) -> tuple:
+        # Colors are kept as RGBW, whatever the strip's pixel order.
+        if isinstance(color, int):
+            return (color >> 16) & 0xFF, (color >> 8) & 0xFF, color & 0xFF, (color >> 24) & 0xFF
+        if len(color) == 3:
+            return (*color, 0)
+        return tuple(color)
+
     def _set_item(self, index: int, r: int, g: int, b: int, w: int):
         if index < 0:
             index += len(self)
         if index >= self._pixels or index < 0:
             raise IndexError
 
-        # self._pixel_buffer[index] = (r, g, b, w)
-        self._delegate.set_item(index, r, g, b, w)
+        offset = index * protocol.BYTES_PER_PIXEL
+        self._pixel_buffer[offset:offset + protocol.BYTES_PER_PIXEL] = (r, g, b, w)
+        self._mark_dirty(index, index + 1)
+
+    def _set_span(self, start: int, stop: int, colors: Sequence[ColorUnion]):
+        bpp = protocol.BYTES_PER_PIXEL
+        if all(not isinstance(color, int) and len(color) == bpp for color in colors):
+            data = b"".join(map(bytes, colors))
+        elif all(not isinstance(color, int) and len(color) == 3 for color in colors):
+            # RGB colors are spread into the RGBW buffer a channel at a time, leaving white at 0.
+            packed = b"".join(map(bytes, colors))
+            data = bytearray(len(colors) * bpp)
+            for channel in range(3):
+                data[channel::bpp] = packed[channel::3]
+        else:
+            data = b"".join(bytes(self._rgbw(color)) for color in colors)
+        self._pixel_buffer[start * bpp:stop * bpp] = data
+        self._mark_dirty(start, stop)
 
     def __setitem__(
         self, index: Union[int, slice], val: Union[ColorUnion, Sequence[ColorUnion]]
     ):
         if isinstance(index, slice):
             start, stop, step = index.indices(self._pixels)
-            for val_i, in_i in enumerate(range(start, stop, step)):
-                r, g, b, w = val[val_i]
-                self._set_item(in_i, r, g, b, w)
+            if step == 1 and stop - start == len(val):
+                self._set_span(start, stop, val)
+            else:
+                for val_i, in_i in enumerate(range(start, stop, step)):
+                    self._set_item(in_i, *self._rgbw(val[val_i]))
         else:
-            r, g, b, w = val
-            self._set_item(index, r, g, b, w)
+            self._set_item(index, *self._rgbw(val))
 
         if self._auto_write:
             self.show()
 
     def _getitem(self, index: int):
-        self._delegate.get_item(index)
-        return self._pixel_buffer[index]
+        # A pixel reads back with as many channels as the strip has.
+        offset = index * protocol.BYTES_PER_PIXEL
+        return tuple(self._pixel_buffer[offset:offset + self._bpp])
 
     def __getitem__(self, index: Union[int, slice]):
         if isinstance(index, slice):
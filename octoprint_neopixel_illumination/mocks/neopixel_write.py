@@ -0,0 +1,6 @@
+from .microcontroller import Pin
+from .neopixel import get_logger
+
+
+def neopixel_write(pin: Pin, buf: bytes):
+    get_logger().info(f"write {pin.id} {bytes(buf).hex()}")
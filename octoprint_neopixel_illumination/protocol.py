@@ -0,0 +1,299 @@
+"""Wire protocol shared by the plugin and the sock_api daemon.
+
+Two encodings are supported on the socket:
+
+- JSON lines, one ``{"command": value}`` object per line (the original format).
+- Binary frames, a 5 byte header of opcode and payload length followed by the
+  packed payload. Pixel frames are carried as raw RGBW bytes.
+
+A client starts every connection in JSON and sends a hello asking for the binary
+protocol. A server that understands it replies with the same hello and both ends
+switch; an older server ignores the hello and the client stays on JSON.
+"""
+import json
+import struct
+
+PROTOCOL_JSON = "json"
+PROTOCOL_BINARY = "binary"
+PROTOCOL_KEY = "protocol"
+HANDSHAKE_TIMEOUT = 1.0
+READY_MESSAGE = "NEOPIXEL_API_READY"
+
+OP_INIT = 0x01
+OP_SHOW = 0x02
+OP_FILL = 0x03
+OP_PIXEL = 0x04
+OP_BRIGHTNESS = 0x05
+OP_FRAME = 0x06
+OP_EFFECT = 0x07
+OP_SHARED_FRAME = 0x08
+OP_FRAME_READY = 0x09
+OP_LAYER = 0x0A
+OP_CLEAR_LAYER = 0x0B
+OP_DEFINE_PRESET = 0x0C
+OP_PRESET = 0x0D
+OP_RELEASE = 0x0E
+
+HEADER = struct.Struct("<BI")
+COLOR = struct.Struct("<4B")
+PIXEL = struct.Struct("<H4B")
+BRIGHTNESS = struct.Struct("<f")
+FRAME_START = struct.Struct("<H")
+FRAME_READY = struct.Struct("<BHH")
+LAYER = struct.Struct("<BB")
+CLEAR_LAYER = struct.Struct("<B")
+PRESET_HEADER = struct.Struct("<fB")
+RELEASE = struct.Struct("<B")
+
+BYTES_PER_PIXEL = 4
+
+PRESET_CACHE_SIZE = 16
+"""Presets the daemon keeps per connection. The least recently used one is evicted first, and a client mirrors
+this to know which presets it has to define again."""
+
+LAYER_BASE = "base"
+LAYER_TEMPERATURE = "temperature"
+LAYER_STATUS = "status"
+LAYER_GCODE = "gcode"
+LAYER_ALERT = "alert"
+LAYERS = [LAYER_BASE, LAYER_TEMPERATURE, LAYER_STATUS, LAYER_GCODE, LAYER_ALERT]
+"""Layers of a strip from bottom to top. A connection writes to the base layer until it selects another."""
+
+BLEND_NORMAL = "normal"
+BLEND_ADD = "add"
+BLEND_MULTIPLY = "multiply"
+BLEND_MODES = [BLEND_NORMAL, BLEND_ADD, BLEND_MULTIPLY]
+
+EFFECTS = ["rainbow", "breathe", "chase", "crossfade"]
+"""Effects the daemon renders, by the name a client starts them with."""
+EFFECT_RESERVED_PARAMS = frozenset(["name", "num_pixels", "current", "current_brightness"])
+"""Arguments the effect is created with besides its params, so no param can be named like them."""
+
+
+def hello(protocol: str) -> bytes:
+    return json_line({PROTOCOL_KEY: protocol})
+
+
+def json_line(data: dict) -> bytes:
+    return json.dumps(data).encode() + b"\n"
+
+
+def pack(opcode: int, payload: bytes = b"") -> bytes:
+    return HEADER.pack(opcode, len(payload)) + payload
+
+
+class JsonEncoder:
+    protocol = PROTOCOL_JSON
+
+    def init(self, config: dict) -> bytes:
+        return json_line({"init": config})
+
+    def show(self) -> bytes:
+        return json_line({"show": ""})
+
+    def fill(self, r: int, g: int, b: int, w: int) -> bytes:
+        return json_line({"fill": (r, g, b, w)})
+
+    def set_item(self, index: int, r: int, g: int, b: int, w: int) -> bytes:
+        return json_line({"pixel": [index, (r, g, b, w)]})
+
+    def set_brightness(self, brightness: float) -> bytes:
+        return json_line({"brightness": brightness})
+
+    def set_frame(self, start: int, data: bytes) -> bytes:
+        return json_line({"frame": [start, data.hex()]})
+
+    def effect(self, name: str, params: dict) -> bytes:
+        return json_line({"effect": {"name": name, "params": params}})
+
+    def shared_frame(self, path: str, num_pixels: int) -> bytes:
+        return json_line({"shared_frame": {"path": path, "n": num_pixels}})
+
+    def frame_ready(self, slot: int, start: int, count: int) -> bytes:
+        return json_line({"frame_ready": [slot, start, count]})
+
+    def select_layer(self, name: str, blend: str) -> bytes:
+        return json_line({"layer": {"name": name, "blend": blend}})
+
+    def clear_layer(self, name: str) -> bytes:
+        return json_line({"clear_layer": name})
+
+    def stats(self) -> bytes:
+        return json_line({"stats": ""})
+
+    def define_preset(self, name: str, brightness: float, data: bytes) -> bytes:
+        return json_line({"define_preset": {"name": name, "brightness": brightness, "frame": data.hex()}})
+
+    def preset(self, name: str) -> bytes:
+        return json_line({"preset": name})
+
+    def release(self, strip: int) -> bytes:
+        return json_line({"release": strip})
+
+
+class BinaryEncoder:
+    protocol = PROTOCOL_BINARY
+
+    _SHOW = pack(OP_SHOW)
+
+    def init(self, config: dict) -> bytes:
+        return pack(OP_INIT, json.dumps(config).encode())
+
+    def show(self) -> bytes:
+        return self._SHOW
+
+    def fill(self, r: int, g: int, b: int, w: int) -> bytes:
+        return pack(OP_FILL, COLOR.pack(r, g, b, w))
+
+    def set_item(self, index: int, r: int, g: int, b: int, w: int) -> bytes:
+        return pack(OP_PIXEL, PIXEL.pack(index, r, g, b, w))
+
+    def set_brightness(self, brightness: float) -> bytes:
+        return pack(OP_BRIGHTNESS, BRIGHTNESS.pack(brightness))
+
+    def set_frame(self, start: int, data: bytes) -> bytes:
+        return HEADER.pack(OP_FRAME, FRAME_START.size + len(data)) + FRAME_START.pack(start) + data
+
+    def effect(self, name: str, params: dict) -> bytes:
+        return pack(OP_EFFECT, json.dumps({"name": name, "params": params}).encode())
+
+    def shared_frame(self, path: str, num_pixels: int) -> bytes:
+        return pack(OP_SHARED_FRAME, json.dumps({"path": path, "n": num_pixels}).encode())
+
+    def frame_ready(self, slot: int, start: int, count: int) -> bytes:
+        return pack(OP_FRAME_READY, FRAME_READY.pack(slot, start, count))
+
+    def select_layer(self, name: str, blend: str) -> bytes:
+        return pack(OP_LAYER, LAYER.pack(LAYERS.index(name), BLEND_MODES.index(blend)))
+
+    def clear_layer(self, name: str) -> bytes:
+        return pack(OP_CLEAR_LAYER, CLEAR_LAYER.pack(LAYERS.index(name)))
+
+    def define_preset(self, name: str, brightness: float, data: bytes) -> bytes:
+        name = name.encode()
+        # A negative brightness stands for none, the preset keeps the strip's brightness.
+        header = PRESET_HEADER.pack(brightness if brightness is not None else -1.0, len(name))
+        return pack(OP_DEFINE_PRESET, header + name + data)
+
+    def preset(self, name: str) -> bytes:
+        return pack(OP_PRESET, name.encode())
+
+    def release(self, strip: int) -> bytes:
+        return pack(OP_RELEASE, RELEASE.pack(strip))
+
+
+ENCODERS = {
+    PROTOCOL_JSON: JsonEncoder,
+    PROTOCOL_BINARY: BinaryEncoder,
+}
+
+
+def decode_json(data: dict):
+    """Yield normalized ``(command, value)`` pairs from a JSON message."""
+    for key, value in data.items():
+        if key == "frame":
+            start, hex_data = value
+            value = (start, bytes.fromhex(hex_data))
+        elif key == "define_preset":
+            value = dict(value, frame=bytes.fromhex(value["frame"]))
+        yield key, value
+
+
+def _lookup(names: list, index: int) -> str:
+    if index >= len(names):
+        raise ValueError("Unknown index {} in {}".format(index, names))
+    return names[index]
+
+
+def decode_binary(opcode: int, payload: bytes):
+    """Return a normalized ``(command, value)`` pair from a binary message."""
+    if opcode == OP_SHOW:
+        return "show", ""
+    elif opcode == OP_FILL:
+        return "fill", COLOR.unpack(payload)
+    elif opcode == OP_PIXEL:
+        index, r, g, b, w = PIXEL.unpack(payload)
+        return "pixel", (index, (r, g, b, w))
+    elif opcode == OP_BRIGHTNESS:
+        return "brightness", BRIGHTNESS.unpack(payload)[0]
+    elif opcode == OP_FRAME:
+        return "frame", (FRAME_START.unpack_from(payload)[0], payload[FRAME_START.size:])
+    elif opcode == OP_INIT:
+        return "init", json.loads(payload)
+    elif opcode == OP_EFFECT:
+        return "effect", json.loads(payload)
+    elif opcode == OP_FRAME_READY:
+        return "frame_ready", FRAME_READY.unpack(payload)
+    elif opcode == OP_SHARED_FRAME:
+        return "shared_frame", json.loads(payload)
+    elif opcode == OP_LAYER:
+        layer, blend = LAYER.unpack(payload)
+        return "layer", {"name": _lookup(LAYERS, layer), "blend": _lookup(BLEND_MODES, blend)}
+    elif opcode == OP_CLEAR_LAYER:
+        return "clear_layer", _lookup(LAYERS, CLEAR_LAYER.unpack(payload)[0])
+    elif opcode == OP_DEFINE_PRESET:
+        brightness, name_length = PRESET_HEADER.unpack_from(payload)
+        name_end = PRESET_HEADER.size + name_length
+        return "define_preset", {
+            "name": payload[PRESET_HEADER.size:name_end].decode(),
+            "brightness": brightness if brightness >= 0 else None,
+            "frame": payload[name_end:],
+        }
+    elif opcode == OP_PRESET:
+        return "preset", payload.decode()
+    elif opcode == OP_RELEASE:
+        return "release", RELEASE.unpack(payload)[0]
+
+    raise ValueError("Unknown opcode {:#04x}".format(opcode))
+
+
+class Decoder:
+    """Splits a byte stream into normalized ``(command, value)`` pairs.
+
+    Data can be fed in arbitrary chunks. The stream starts as JSON lines and
+    switches to binary frames after a binary hello, which is reported as a
+    ``(PROTOCOL_KEY, protocol)`` command so the caller can answer it.
+    """
+
+    def __init__(self):
+        self.protocol = PROTOCOL_JSON
+        self._buffer = bytearray()
+
+    def feed(self, data: bytes) -> list:
+        buffer = self._buffer
+        buffer += data
+        commands = []
+        while buffer:
+            if self.protocol == PROTOCOL_BINARY:
+                if len(buffer) < HEADER.size:
+                    break
+                opcode, length = HEADER.unpack_from(buffer)
+                end = HEADER.size + length
+                if len(buffer) < end:
+                    break
+                payload = bytes(buffer[HEADER.size:end])
+                del buffer[:end]
+                try:
+                    commands.append(decode_binary(opcode, payload))
+                except ValueError as e:
+                    commands.append(("error", str(e)))
+            else:
+                newline = buffer.find(b"\n")
+                if newline < 0:
+                    break
+                line = bytes(buffer[:newline]).strip()
+                del buffer[:newline + 1]
+                if not line.startswith(b"{"):
+                    continue
+                try:
+                    message = json.loads(line)
+                except ValueError as e:
+                    commands.append(("error", str(e)))
+                    continue
+                if PROTOCOL_KEY in message:
+                    if message[PROTOCOL_KEY] in ENCODERS:
+                        self.protocol = message[PROTOCOL_KEY]
+                    commands.append((PROTOCOL_KEY, message[PROTOCOL_KEY]))
+                else:
+                    commands.extend(decode_json(message))
+        return commands
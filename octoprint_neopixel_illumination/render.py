@@ -0,0 +1,349 @@
+"""Frame buffers and color transforms for the sock_api daemon.
+
+A frame holds one RGBW byte quad per pixel. With NumPy it is a ``uint8`` array of
+shape ``(n, 4)`` and transforms are vectorized; without it the frame is a flat
+``bytearray`` and lookup tables are applied with ``bytes.translate``. The backend
+is picked once at import time and both expose the same functions.
+
+A strip is composited from the layers in ``protocol.LAYERS``. Every layer has its
+own frame, a mask of the pixels it covers and a blend mode, and each covered
+layer is blended over the ones below it in a single pass when the strip is shown.
+"""
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import protocol
+
+BYTES_PER_PIXEL = 4
+GAMMA_DEFAULT = 1.0
+FRAME_CHANNELS = "RGBW"
+PIXEL_ORDER_DEFAULT = "GRB"
+
+
+def wire_channels(pixel_order: str) -> list:
+    """Frame channel of every byte a pixel is sent as, e.g. ``[1, 0, 2]`` for GRB."""
+    pixel_order = (pixel_order or PIXEL_ORDER_DEFAULT).upper()
+    if not 3 <= len(pixel_order) <= 4 or any(channel not in FRAME_CHANNELS for channel in pixel_order):
+        raise ValueError("Unsupported pixel order `{}`".format(pixel_order))
+    return [FRAME_CHANNELS.index(channel) for channel in pixel_order]
+
+
+def _lut_values(brightness: float, gamma: float):
+    brightness = min(max(brightness, 0.0), 1.0)
+    return [int(round(255 * brightness * (i / 255) ** gamma)) for i in range(256)]
+
+
+if numpy is not None:
+    BACKEND = "numpy"
+
+    def new_frame(num_pixels: int):
+        return numpy.zeros((num_pixels, BYTES_PER_PIXEL), numpy.uint8)
+
+    def pixel_count(frame) -> int:
+        return len(frame)
+
+    def copy_frame(frame):
+        return frame.copy()
+
+    def frame_from_bytes(data: bytes):
+        return numpy.frombuffer(data, numpy.uint8).reshape(-1, BYTES_PER_PIXEL).copy()
+
+    def frame_to_bytes(frame) -> bytes:
+        return frame.tobytes()
+
+    def solid(num_pixels: int, color):
+        frame = new_frame(num_pixels)
+        frame[:] = color
+        return frame
+
+    def fill(frame, color):
+        frame[:] = color
+
+    def set_pixel(frame, index: int, color):
+        frame[index] = color
+
+    def write(frame, start: int, data: bytes):
+        values = numpy.frombuffer(data, numpy.uint8).reshape(-1, BYTES_PER_PIXEL)
+        frame[start:start + len(values)] = values
+
+    def build_lut(brightness: float, gamma: float = GAMMA_DEFAULT):
+        return numpy.array(_lut_values(brightness, gamma), numpy.uint8)
+
+    def apply_lut(frame, lut):
+        return lut[frame]
+
+    def scale(frame, level: float):
+        return apply_lut(frame, build_lut(level))
+
+    def blend(start, end, t: float):
+        return (start + (end.astype(numpy.int16) - start) * t).astype(numpy.uint8)
+
+    def palette(colors):
+        return numpy.array(colors, numpy.uint8).reshape(-1, BYTES_PER_PIXEL)
+
+    def index_array(values):
+        return numpy.fromiter(values, numpy.intp)
+
+    def index_palette(table, indices, shift: int = 0):
+        return table[(indices + shift) % len(table)]
+
+    def channel_index(channels: list):
+        return numpy.array(channels, numpy.intp)
+
+    def to_wire(frame, channels, out: bytearray, lut=None):
+        # One gather reorders and drops channels for the whole strip, the table then only sees the bytes sent.
+        wire = numpy.frombuffer(out, numpy.uint8).reshape(-1, len(channels))
+        if lut is None:
+            numpy.take(frame, channels, axis=1, out=wire)
+        else:
+            numpy.take(lut, frame[:, channels], out=wire)
+
+    def new_mask(num_pixels: int, covered: bool = False):
+        return numpy.full(num_pixels, covered, bool)
+
+    def cover(mask, start: int, stop: int):
+        mask[start:stop] = True
+
+    def uncover(mask):
+        mask[:] = False
+
+    def blend_layer(below, frame, mask, mode: str):
+        if mode == protocol.BLEND_ADD:
+            frame = numpy.minimum(below.astype(numpy.uint16) + frame, 255).astype(numpy.uint8)
+        elif mode == protocol.BLEND_MULTIPLY:
+            frame = (below.astype(numpy.uint16) * frame // 255).astype(numpy.uint8)
+        return numpy.where(mask[:, None], frame, below)
+
+else:
+    BACKEND = "python"
+
+    def new_frame(num_pixels: int):
+        return bytearray(num_pixels * BYTES_PER_PIXEL)
+
+    def pixel_count(frame) -> int:
+        return len(frame) // BYTES_PER_PIXEL
+
+    def copy_frame(frame):
+        return bytearray(frame)
+
+    def frame_from_bytes(data: bytes):
+        return bytearray(data)
+
+    def frame_to_bytes(frame) -> bytes:
+        return bytes(frame)
+
+    def solid(num_pixels: int, color):
+        return bytearray(bytes(color) * num_pixels)
+
+    def fill(frame, color):
+        frame[:] = bytes(color) * pixel_count(frame)
+
+    def set_pixel(frame, index: int, color):
+        if index < 0:
+            index += pixel_count(frame)
+        offset = index * BYTES_PER_PIXEL
+        frame[offset:offset + BYTES_PER_PIXEL] = bytes(color)
+
+    def write(frame, start: int, data: bytes):
+        offset = start * BYTES_PER_PIXEL
+        frame[offset:offset + len(data)] = data
+
+    def build_lut(brightness: float, gamma: float = GAMMA_DEFAULT):
+        return bytes(_lut_values(brightness, gamma))
+
+    def apply_lut(frame, lut):
+        return bytearray(frame.translate(lut))
+
+    def scale(frame, level: float):
+        return apply_lut(frame, build_lut(level))
+
+    def blend(start, end, t: float):
+        return bytearray(int(s + (e - s) * t) for s, e in zip(start, end))
+
+    def palette(colors):
+        return [bytes(color) for color in colors]
+
+    def index_array(values):
+        return list(values)
+
+    def index_palette(table, indices, shift: int = 0):
+        size = len(table)
+        return bytearray(b"".join([table[(i + shift) % size] for i in indices]))
+
+    def channel_index(channels: list):
+        return tuple(channels)
+
+    def to_wire(frame, channels, out: bytearray, lut=None):
+        # One extended slice copy per wire channel, however long the strip is.
+        bpp = len(channels)
+        for offset, channel in enumerate(channels):
+            out[offset::bpp] = frame[channel::BYTES_PER_PIXEL]
+        if lut is not None:
+            out[:] = out.translate(lut)
+
+    def new_mask(num_pixels: int, covered: bool = False):
+        return bytearray(b"\x01" * num_pixels if covered else num_pixels)
+
+    def cover(mask, start: int, stop: int):
+        stop = min(stop, len(mask))
+        mask[start:stop] = b"\x01" * (stop - start)
+
+    def uncover(mask):
+        mask[:] = bytes(len(mask))
+
+    def _blend_pixel(below: bytes, above: bytes, mode: str) -> bytes:
+        if mode == protocol.BLEND_ADD:
+            return bytes(min(b + a, 255) for b, a in zip(below, above))
+        if mode == protocol.BLEND_MULTIPLY:
+            return bytes(b * a // 255 for b, a in zip(below, above))
+        return above
+
+    def blend_layer(below, frame, mask, mode: str):
+        out = bytearray(below)
+        start = mask.find(1)
+        while start >= 0:
+            stop = mask.find(0, start)
+            if stop < 0:
+                stop = len(mask)
+            for offset in range(start * BYTES_PER_PIXEL, stop * BYTES_PER_PIXEL, BYTES_PER_PIXEL):
+                end = offset + BYTES_PER_PIXEL
+                out[offset:end] = _blend_pixel(below[offset:end], frame[offset:end], mode)
+            start = mask.find(1, stop)
+        return out
+
+
+class Layer:
+    """One layer of a strip. Only the pixels it covers are blended over the layers below."""
+
+    def __init__(self, num_pixels: int, covered: bool = False):
+        self.frame = new_frame(num_pixels)
+        self.mask = new_mask(num_pixels, covered)
+        self.blend = protocol.BLEND_NORMAL
+        self.active = covered
+        self._always_covered = covered
+
+    def fill(self, color):
+        fill(self.frame, color)
+        self.cover(0, len(self.mask))
+
+    def set_pixel(self, index: int, color):
+        if index < 0:
+            index += len(self.mask)
+        set_pixel(self.frame, index, color)
+        self.cover(index, index + 1)
+
+    def write(self, start: int, data: bytes):
+        stop = start + len(data) // BYTES_PER_PIXEL
+        if start < 0 or stop > len(self.mask) or len(data) % BYTES_PER_PIXEL:
+            raise ValueError("Pixels {} to {} are outside the strip of {}".format(start, stop, len(self.mask)))
+        write(self.frame, start, data)
+        self.cover(start, start + len(data) // BYTES_PER_PIXEL)
+
+    def set_frame(self, frame):
+        self.frame = frame
+        self.cover(0, len(self.mask))
+
+    def cover(self, start: int, stop: int):
+        if not self._always_covered:
+            cover(self.mask, start, stop)
+            self.active = True
+
+    def clear(self):
+        if self._always_covered:
+            fill(self.frame, (0, 0, 0, 0))
+        else:
+            uncover(self.mask)
+            self.active = False
+
+
+class Strip:
+    """Layered frames of a strip and the function that puts them on the hardware.
+
+    Frames are RGBW whatever the strip. When the strip is shown the composited
+    frame is converted to the bytes the strip expects, in its pixel order and
+    without a white channel it doesn't have, and brightness and gamma are
+    applied through a 256 entry lookup table on the way, so the hardware is
+    always run at full brightness. ``write`` gets those bytes, in the same
+    ``bytearray`` every time, as Blinka's Raspberry Pi driver sets up its DMA
+    buffer again for any other one.
+
+    A show that would send the same bytes again is skipped, ``shown`` and
+    ``skipped`` count both outcomes.
+    """
+
+    def __init__(
+        self,
+        write,
+        num_pixels: int,
+        brightness: float = 1.0,
+        gamma: float = GAMMA_DEFAULT,
+        pixel_order: str = PIXEL_ORDER_DEFAULT,
+    ):
+        self.write = write
+        channels = wire_channels(pixel_order)
+        self._channels = channel_index(channels)
+        # The base layer always covers the whole strip.
+        self.layers = {name: Layer(num_pixels, name == protocol.LAYER_BASE) for name in protocol.LAYERS}
+        self.base = self.layers[protocol.LAYER_BASE]
+        self.gamma = gamma
+        self.brightness = None
+        self.shown = 0
+        self.skipped = 0
+        self._lut = None
+        # Each show renders into the next output and only copies it to the output written when it differs.
+        self._output = bytearray(num_pixels * len(channels))
+        self._next_output = bytearray(len(self._output))
+        self._written = False
+        self.set_brightness(brightness)
+
+    def __len__(self):
+        return pixel_count(self.base.frame)
+
+    @property
+    def frame(self):
+        return self.base.frame
+
+    def layer(self, name: str = protocol.LAYER_BASE) -> Layer:
+        return self.layers[name]
+
+    def clear_overlays(self):
+        for layer in self.layers.values():
+            if layer is not self.base:
+                layer.clear()
+
+    def composite(self, top: str = None):
+        """Blend the covered layers from the bottom up to ``top``, or all of them."""
+        frame = self.base.frame
+        for name in protocol.LAYERS[1:]:
+            if top is not None and protocol.LAYERS.index(name) > protocol.LAYERS.index(top):
+                break
+            layer = self.layers[name]
+            if layer.active:
+                frame = blend_layer(frame, layer.frame, layer.mask, layer.blend)
+        return frame
+
+    def set_brightness(self, brightness: float):
+        self.brightness = brightness
+        if brightness >= 1.0 and self.gamma == 1.0:
+            self._lut = None
+        else:
+            self._lut = build_lut(brightness, self.gamma)
+
+    def output(self) -> bytes:
+        to_wire(self.composite(), self._channels, self._next_output, self._lut)
+        return bytes(self._next_output)
+
+    def show(self) -> bool:
+        to_wire(self.composite(), self._channels, self._next_output, self._lut)
+        if self._written and self._next_output == self._output:
+            self.skipped += 1
+            return False
+        self._output[:] = self._next_output
+        # Not skipped next time if the write fails.
+        self._written = False
+        self.write(self._output)
+        self._written = True
+        self.shown += 1
+        return True
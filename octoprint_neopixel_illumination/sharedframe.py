@@ -0,0 +1,82 @@
+"""Double buffered pixel frames shared between the plugin and sock_api.
+
+The plugin creates a memory mapped file holding two frame slots and writes pixel
+bytes straight into the slot the daemon is not reading, then sends a tiny
+``frame_ready`` message naming the slot and pixel span. The daemon maps the same
+file and copies that span into its strip without any decoding.
+
+The file can be split into regions with their own pair of slots, so writers that
+interleave frames, like the layers of a strip, never overwrite each other's
+frames before they are read.
+"""
+import mmap
+import os
+import re
+import stat
+
+SHARED_FRAME_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else "/tmp"
+SHARED_FRAME_PATH = os.path.join(SHARED_FRAME_DIR, "neopixel_frame")
+SLOTS = 2
+
+
+def is_shared_frame_path(path: str) -> bool:
+    """Whether ``path`` is one the plugin creates shared frames at, ``SHARED_FRAME_PATH`` or ``SHARED_FRAME_PATH.<n>``."""
+    shared_frame_dir = os.path.realpath(SHARED_FRAME_DIR)
+    path = os.path.realpath(path)
+    return os.path.dirname(path) == shared_frame_dir and re.fullmatch(
+        re.escape(os.path.basename(SHARED_FRAME_PATH)) + r"(\.\d+)?", os.path.basename(path)
+    ) is not None
+
+
+class SharedFrameBuffer:
+    def __init__(self, path: str, num_pixels: int, bytes_per_pixel: int, create: bool = False, regions: int = 1):
+        self.path = path
+        self.num_pixels = num_pixels
+        self.bytes_per_pixel = bytes_per_pixel
+        self.slots = SLOTS * regions
+        self.slot_size = num_pixels * bytes_per_pixel
+        size = max(self.slot_size * SLOTS * regions, 1)
+
+        if create:
+            # Never resize a file the daemon may still have mapped, replace it instead.
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o600)
+            os.ftruncate(fd, size)
+        else:
+            # The file sits in a world writable directory, so only map a plain file of exactly the expected size.
+            fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW)
+            status = os.fstat(fd)
+            if not stat.S_ISREG(status.st_mode) or status.st_nlink != 1 or status.st_size != size:
+                os.close(fd)
+                raise ValueError("`{}` is not a shared frame of {} pixels".format(path, num_pixels))
+
+        try:
+            access = mmap.ACCESS_WRITE if create else mmap.ACCESS_READ
+            self._map = mmap.mmap(fd, size, access=access)
+        finally:
+            os.close(fd)
+
+        self._view = memoryview(self._map)
+        self._next_slots = [0] * regions
+
+    def write(self, start: int, data: bytes, region: int = 0) -> int:
+        """Copy ``data`` into the back slot of ``region`` at pixel ``start`` and return the slot index."""
+        next_slot = self._next_slots[region]
+        self._next_slots[region] = (next_slot + 1) % SLOTS
+        slot = region * SLOTS + next_slot
+        offset = slot * self.slot_size + start * self.bytes_per_pixel
+        self._view[offset:offset + len(data)] = data
+        return slot
+
+    def read(self, slot: int, start: int, count: int) -> memoryview:
+        if not 0 <= slot < self.slots or start < 0 or count < 0 or start + count > self.num_pixels:
+            raise ValueError("Slot {} pixels {}+{} are outside the shared frame".format(slot, start, count))
+        offset = slot * self.slot_size + start * self.bytes_per_pixel
+        return self._view[offset:offset + count * self.bytes_per_pixel]
+
+    def close(self):
+        self._view.release()
+        self._map.close()
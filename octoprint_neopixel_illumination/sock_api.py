@@ -1,11 +1,31 @@
+import collections
+import functools
 import getopt
 import json
 import logging
 import os
+import queue
+import selectors
+import socket
 import sys
-from socketserver import UnixStreamServer, StreamRequestHandler
+import threading
+import time
+
+import effects
+import metrics
+import protocol
+import render
+import sharedframe
 
 SOCKET_SERVER_ADDRESS = "/tmp/neopixel_socket"
+FRAME_RATE = 30
+COMMAND_QUEUE_SIZE = 1024
+RECEIVE_SIZE = 65536
+STATE_SAVE_INTERVAL = 2.0
+
+WRITE_COMMANDS = frozenset(["fill", "pixel", "frame", "frame_ready", "preset"])
+
+STARTED_AT = time.monotonic()
 
 logger: logging.Logger = None
 
@@ -29,71 +49,536 @@ def setup_logger(log_path):
 try:
     import microcontroller
     import neopixel
+    import neopixel_write
 except:
     import mocks.microcontroller as microcontroller
     import mocks.neopixel as neopixel
+    import mocks.neopixel_write as neopixel_write
 
 PIXEL_CONFIG_DEFAULT = {
     "brightness": 1.0,
-    "auto_write": True,
+    "auto_write": False,
 }
 
-pixels: neopixel.NeoPixel = None
+strips: dict = {}
+"""Strips by index, index 0 being the one configured in the plugin's main settings."""
+renderer: "Renderer" = None
+api_metrics = metrics.Metrics()
+"""Counters and latencies of the daemon, each written either by the server thread or by the renderer."""
+
+
+class PresetCache:
+    """Rendered presets of one connection, evicting the least recently used beyond ``size``."""
+
+    def __init__(self, size: int = protocol.PRESET_CACHE_SIZE):
+        self.size = size
+        self._presets = collections.OrderedDict()
+
+    def define(self, name: str, frame, brightness: float):
+        self._presets[name] = (frame, brightness)
+        self._presets.move_to_end(name)
+        if len(self._presets) > self.size:
+            self._presets.popitem(last=False)
+
+    def get(self, name: str):
+        preset = self._presets.get(name)
+        if preset is not None:
+            self._presets.move_to_end(name)
+        return preset
+
+    def clear(self):
+        self._presets.clear()
+
+
+class Client:
+    """Connection state of one socket client."""
+
+    def __init__(self, sock: socket.socket = None):
+        self.socket = sock
+        self.decoder = protocol.Decoder()
+        self.shared_frame: sharedframe.SharedFrameBuffer = None
+        self.presets = PresetCache()
+        self.strip = 0
+        self.layer = protocol.LAYER_BASE
+        self.name = "client-{}".format(sock.fileno()) if sock is not None else "state"
+
+
+class RunningEffect:
+    """An effect rendering into one layer of a strip."""
+
+    def __init__(self, effect: effects.Effect, layer: str):
+        self.effect = effect
+        self.layer = layer
+        self.started = time.monotonic()
+
 
+class Renderer(threading.Thread):
+    """The only thread that touches ``strips``.
 
-class Handler(StreamRequestHandler):
-    def process_data(self, data: dict):
-        global pixels
+    Commands from every client are queued in arrival order and applied between
+    frames, and the active effects are rendered on a fixed frame rate schedule.
+    A ``show`` only marks its strip, the marked strips are pushed to their
+    drivers together once the queued commands are applied or an effect frame
+    is rendered. They are written one after another, the Raspberry Pi driver
+    keeps a single handle for every pin and isn't safe to call from several
+    threads. A failing command, driver or save is logged and the renderer
+    carries on.
 
+    With a ``state_path`` the config, brightness and last shown frame of every
+    strip are saved there once nothing was shown for ``STATE_SAVE_INTERVAL``
+    seconds, and only when they differ from what was saved last, so a stream of
+    frames doesn't keep rewriting the file. ``restore_state`` restores them
+    when the daemon starts.
+    """
+
+    def __init__(self, frame_rate: int = FRAME_RATE, state_path: str = None):
+        super().__init__(name="Renderer", daemon=True)
+        self._interval = 1.0 / frame_rate
+        self._queue = queue.Queue(COMMAND_QUEUE_SIZE)
+        # Running effects by (strip index, layer), every layer of a strip can run one of its own.
+        self._effects = {}
+        self._next_frame = 0.0
+        self._configs = {}
+        self._driver_configs = {}
+        # Drivers by strip index, they hold the pins.
+        self._drivers = {}
+        self._pending_shows = set()
+        self._shows_due = 0.0
+        self._state_path = state_path
+        self._state_dirty = False
+        # When a strip was last shown, and the state as last saved.
+        self._state_changed = 0.0
+        self._saved_state: str = None
+        self._first_frame_shown = False
+        # When the commands being processed arrived, or the effect frame being rendered was due.
+        self._request_time = 0.0
+        self._shows_requested = 0.0
+        self._show_latency = api_metrics.histogram("show_latency")
+        self._show_time = api_metrics.histogram("show_time")
+        self._frames = api_metrics.meter("frames")
+        self._missed_frames = api_metrics.meter("missed_frames")
+
+    def submit(self, client: Client, commands: list):
+        # Blocks when the renderer falls behind, which pushes back on the clients through their sockets.
+        self._queue.put((client, commands, time.monotonic()))
+
+    def run(self):
+        while True:
+            try:
+                self.run_once()
+            except:
+                logger.exception("Fail.")
+
+    def run_once(self):
+        """Wait for the next command or deadline, then apply the commands and do whatever is due."""
+        deadlines = []
+        if self._effects:
+            deadlines.append(self._next_frame)
+        if self._pending_shows:
+            deadlines.append(self._shows_due)
+        if self._state_dirty:
+            deadlines.append(self._state_changed + STATE_SAVE_INTERVAL)
+        timeout = max(min(deadlines) - time.monotonic(), 0) if deadlines else None
+
+        try:
+            client, commands, self._request_time = self._queue.get(timeout=timeout)
+            self.process(client, commands)
+        except queue.Empty:
+            pass
+
+        now = time.monotonic()
+        if self._effects and now >= self._next_frame:
+            self.render_effects()
+        if self._pending_shows and (self._queue.empty() or now >= self._shows_due):
+            self.show_pending()
+        if self._state_dirty and now >= self._state_changed + STATE_SAVE_INTERVAL:
+            self.save_state()
+
+    def request_show(self, index: int):
+        if not self._pending_shows:
+            # Wait for the commands queued behind this show, but never longer than a frame.
+            self._shows_due = time.monotonic() + self._interval
+            self._shows_requested = self._request_time
+        self._pending_shows.add(index)
+
+    def show_pending(self):
+        shown = [index for index in self._pending_shows if index in strips]
+        self._pending_shows.clear()
+        if not shown:
+            return
+        started = time.perf_counter()
+        written = sum(self.show_strip(index) for index in shown)
+        self._show_time.observe(time.perf_counter() - started)
+        self._show_latency.observe(time.monotonic() - self._shows_requested)
+        self._frames.mark(written)
+
+        if not self._first_frame_shown:
+            self._first_frame_shown = True
+            logger.info("First frame shown {:.0f} ms after start".format((time.monotonic() - STARTED_AT) * 1000))
+
+    def show_strip(self, index: int) -> bool:
+        """Write strip ``index`` to its driver, return whether a frame went out."""
         try:
-            for key, value in data.items():
-                if key == "init":
-                    pixel_config = {**PIXEL_CONFIG_DEFAULT, **value}
-                    pixel_config["pin"] = microcontroller.Pin(pixel_config["pin"])
-                    pixels = neopixel.NeoPixel(**pixel_config)
-                elif key == "fill":
-                    pixels.fill(value)
-                elif key == "pixel":
-                    index, color = value
-                    pixels[index] = color
-                elif key == "brightness":
-                    pixels.brightness = float(value)
-                elif key == "show":
-                    pixels.show()
+            return strips[index].show()
         except:
-            logger.exception("Fail.")
+            # One strip's driver failing doesn't hold up the others.
+            logger.exception("Could not show strip {}".format(index))
+            return False
 
-    def handle(self):
-        while True:
-            message = self.rfile.readline().strip()
-            message = message.decode()
-            if logger.isEnabledFor(logging.DEBUG):
-                logger.debug("message `{}`".format(message))
-            if message and message.startswith("{"):
-                self.process_data(json.loads(message))
-            else:
+    def stats(self) -> dict:
+        return {
+            "uptime": time.monotonic() - STARTED_AT,
+            "strips": {
+                str(index): {"pixels": len(strip), "shown": strip.shown, "skipped": strip.skipped}
+                for index, strip in strips.items()
+            },
+            "metrics": api_metrics.snapshot(),
+        }
+
+    def state_changed(self):
+        """Note that a strip was shown, which puts the next save off for another ``STATE_SAVE_INTERVAL``."""
+        self._state_dirty = self._state_path is not None
+        self._state_changed = time.monotonic()
+
+    def save_state(self):
+        self._state_dirty = False
+        state = {
+            "strips": {
+                str(index): {
+                    "config": self._configs[index],
+                    "brightness": strip.brightness,
+                    "frame": render.frame_to_bytes(strip.frame).hex(),
+                }
+                for index, strip in strips.items()
+            },
+        }
+        try:
+            data = json.dumps(state)
+            if data == self._saved_state:
+                # Shown again, but nothing to keep changed, e.g. a strip going back to the same color.
                 return
+            temp_path = self._state_path + ".tmp"
+            # Only root gets to read the state, also when a file was left behind with other permissions.
+            fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW, 0o600)
+            os.fchmod(fd, 0o600)
+            with open(fd, "w") as state_file:
+                state_file.write(data)
+            os.replace(temp_path, self._state_path)
+            self._saved_state = data
+        except (OSError, TypeError, ValueError):
+            logger.exception("Could not save state to `{}`".format(self._state_path))
 
+    def restore_state(self):
+        """Put the last saved frames back on the strips, before any client has connected."""
+        if not self._state_path or not os.path.exists(self._state_path):
+            return
+        try:
+            with open(self._state_path) as state_file:
+                data = state_file.read()
+            state = json.loads(data)
+            self._request_time = time.monotonic()
+            # A state saved before there were several strips is the state of the first one.
+            for strip_state in state["strips"].values() if "strips" in state else [state]:
+                self.process(Client(), [
+                    ("init", strip_state["config"]),
+                    ("brightness", strip_state["brightness"]),
+                    ("frame", (0, bytes.fromhex(strip_state["frame"]))),
+                    ("show", ""),
+                ])
+            self.show_pending()
+            self._saved_state = data
+            logger.info("Restored state from `{}`".format(self._state_path))
+        except (OSError, ValueError, KeyError, TypeError):
+            logger.exception("Could not restore state from `{}`".format(self._state_path))
+
+    def start_effect(self, index: int, name: str, params: dict, layer: str = protocol.LAYER_BASE):
+        self.stop_effect(index, layer)
+        strip = strips.get(index)
+        if not name or strip is None:
+            return
+        # Start from what the layer looks like on the strip, including the layers below it.
+        effect = effects.create(name, len(strip), strip.composite(layer), params or {}, strip.brightness)
+        if not self._effects:
+            self._next_frame = time.monotonic()
+        self._effects[(index, layer)] = RunningEffect(effect, layer)
+        logger.info("Started effect `{}` {} on strip {} layer {}".format(name, params, index, layer))
+
+    def stop_effect(self, index: int, layer: str = None):
+        """Stop the effect running on ``layer`` of strip ``index``, or every effect of the strip without a layer."""
+        for key in [key for key in self._effects if key[0] == index and layer in (None, key[1])]:
+            running = self._effects.pop(key)
+            if running.effect.final_brightness is not None:
+                strips[index].set_brightness(running.effect.final_brightness)
+
+    def render_effects(self):
+        now = time.monotonic()
+        self._request_time = self._next_frame
+        for key, running in list(self._effects.items()):
+            index = key[0]
+            effect = running.effect
+            strip = strips[index]
+            try:
+                frame = effect.render(now - running.started)
+                if frame is not None:
+                    strip.layer(running.layer).set_frame(frame)
+                if effect.brightness is not None:
+                    strip.set_brightness(effect.brightness)
+                self.request_show(index)
+            except:
+                logger.exception("Effect failed.")
+                effect.done = True
+            if effect.done:
+                del self._effects[key]
+                # Keep the frame an effect finished on, like an explicit show.
+                self.state_changed()
+        # All strips running an effect go out within the same frame.
+        self.show_pending()
+
+        self._next_frame += self._interval
+        now = time.monotonic()
+        if self._next_frame < now:
+            # Running behind, skip the missed frames instead of bursting to catch up.
+            self._missed_frames.mark(int((now - self._next_frame) / self._interval))
+            self._next_frame = now
+
+    def process(self, client: Client, commands: list):
+        for key, value in commands:
+            try:
+                self.process_command(client, key, value)
+            except:
+                logger.exception("Fail.")
+
+    def process_command(self, client: Client, key: str, value):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("{} `{}`".format(client.name, key))
+
+        if key == "init":
+            self.init_strip(client, value)
+            return
+        if key == "release":
+            self.release_strip(int(value))
+            return
+        if key == "stats":
+            # Answered with a JSON line whatever the connection's protocol, it is asked for on a connection of its own.
+            try:
+                client.socket.send(protocol.json_line({"stats": self.stats()}))
+            except OSError:
+                pass
+            return
+
+        index = client.strip
+        strip = strips.get(index)
+        layer_name = client.layer
+        if key in WRITE_COMMANDS and (index, layer_name) in self._effects:
+            # Direct writes take over the layer from a running effect.
+            self.stop_effect(index, layer_name)
+
+        if key == "fill":
+            strip.layer(layer_name).fill(value)
+        elif key == "pixel":
+            pixel, color = value
+            strip.layer(layer_name).set_pixel(pixel, color)
+        elif key == "frame":
+            start, frame = value
+            strip.layer(layer_name).write(start, frame)
+        elif key == "frame_ready":
+            slot, start, count = value
+            strip.layer(layer_name).write(start, client.shared_frame.read(slot, start, count))
+        elif key == "layer":
+            client.layer = value["name"]
+            strip.layer(client.layer).blend = value.get("blend") or protocol.BLEND_NORMAL
+        elif key == "clear_layer":
+            self.stop_effect(index, value)
+            strip.layer(value).clear()
+        elif key == "shared_frame":
+            if client.shared_frame is not None:
+                client.shared_frame.close()
+                client.shared_frame = None
+            # Any local user can connect, never map a file the plugin didn't create for this.
+            if not sharedframe.is_shared_frame_path(value["path"]):
+                raise ValueError("`{}` is not a shared frame path".format(value["path"]))
+            client.shared_frame = sharedframe.SharedFrameBuffer(
+                value["path"], value["n"], protocol.BYTES_PER_PIXEL, regions=len(protocol.LAYERS)
+            )
+            logger.info("Attached shared frame `{}`".format(value["path"]))
+        elif key == "brightness":
+            strip.set_brightness(float(value))
+        elif key == "show":
+            self.request_show(index)
+            self.state_changed()
+        elif key == "effect":
+            self.start_effect(index, value.get("name"), value.get("params"), layer_name)
+        elif key == "define_preset":
+            frame = value["frame"]
+            if len(frame) != len(strip) * protocol.BYTES_PER_PIXEL:
+                raise ValueError("Preset `{}` does not fit strip {}".format(value["name"], index))
+            client.presets.define(value["name"], render.frame_from_bytes(frame), value["brightness"])
+        elif key == "preset":
+            preset = client.presets.get(value)
+            if preset is None:
+                logger.warning("{} activated unknown preset `{}`".format(client.name, value))
+                return
+            frame, brightness = preset
+            # Layers are written in place, so the cached frame is copied rather than shared.
+            strip.layer(layer_name).set_frame(render.copy_frame(frame))
+            if brightness is not None:
+                strip.set_brightness(brightness)
+        elif key == "close":
+            if client.shared_frame is not None:
+                client.shared_frame.close()
+                client.shared_frame = None
+        elif key == "error":
+            logger.error("{} sent an invalid message: {}".format(client.name, value))
+
+    def init_strip(self, client: Client, config: dict):
+        """Bind ``client`` to the strip its config names, creating or recreating the strip as needed."""
+        pixel_config = {**PIXEL_CONFIG_DEFAULT, **config}
+        index = int(pixel_config.pop("strip", 0))
+        client.strip = index
+        client.layer = protocol.LAYER_BASE
+        # The presets were rendered for the strip as it was configured before.
+        client.presets.clear()
+        self.stop_effect(index)
+
+        # Brightness and gamma are applied by the strip's lookup table, not the driver.
+        brightness = float(pixel_config.pop("brightness"))
+        gamma = float(pixel_config.pop("gamma", render.GAMMA_DEFAULT))
+        strip = strips.get(index)
+        self._configs[index] = config
+        if strip is not None and pixel_config == self._driver_configs[index]:
+            # Same hardware, e.g. a client reconnecting, so keep the driver and what it shows.
+            strip.gamma = gamma
+            strip.set_brightness(brightness)
+            strip.clear_overlays()
+            return
+
+        for other, driver_config in list(self._driver_configs.items()):
+            if other != index and driver_config["pin"] == pixel_config["pin"]:
+                # A strip removed without the daemon hearing of it, e.g. restored from the saved state.
+                self.release_strip(other)
+        if index in self._drivers:
+            self._drivers.pop(index).deinit()
+
+        self._driver_configs[index] = dict(pixel_config)
+        pixel_config["pin"] = microcontroller.Pin(pixel_config["pin"])
+        # The driver only claims and holds the pin, frames are written to it already in the strip's byte order.
+        driver = self._drivers[index] = neopixel.NeoPixel(**pixel_config)
+        write = functools.partial(neopixel_write.neopixel_write, driver.pin)
+        strips[index] = strip = render.Strip(
+            write, pixel_config["n"], brightness, gamma, pixel_config.get("pixel_order")
+        )
+        logger.info("Created strip {} of {} pixels using {} rendering".format(index, len(strip), render.BACKEND))
+
+    def release_strip(self, index: int):
+        """Forget strip ``index`` and release its pin, so neither comes back with the saved state."""
+        if index not in strips:
+            return
+        self.stop_effect(index)
+        if index in self._pending_shows:
+            # Put out the last frame shown, usually the strip being turned off.
+            self._pending_shows.discard(index)
+            self.show_strip(index)
+        del strips[index]
+        self._configs.pop(index, None)
+        self._driver_configs.pop(index, None)
+        driver = self._drivers.pop(index, None)
+        if driver is not None:
+            driver.deinit()
+        self.state_changed()
+        logger.info("Released strip {}".format(index))
 
-class ThreadedUnixStreamServer(UnixStreamServer):
-    def __init__(self, server_address, RequestHandlerClass, bind_and_activate: bool = ...) -> None:
-        super().__init__(server_address, RequestHandlerClass, bind_and_activate)
+
+class SelectorServer:
+    """Unix socket server multiplexing any number of clients on one thread.
+
+    Received bytes are decoded per client and handed to the renderer, which is
+    the single owner of the strip.
+    """
+
+    def __init__(self, server_address: str, renderer: Renderer):
+        self._renderer = renderer
+        self._connections = api_metrics.meter("connections")
+        self._messages = api_metrics.meter("messages")
+        self._bytes_received = api_metrics.meter("bytes_received")
+        self._selector = selectors.DefaultSelector()
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listener.bind(server_address)
         os.chmod(server_address, 0o777)
+        self._listener.listen()
+        self._listener.setblocking(False)
+        self._selector.register(self._listener, selectors.EVENT_READ)
         logger.info("Server is running on {}".format(server_address))
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.server_close()
+
+    def serve_forever(self):
+        while True:
+            for key, _ in self._selector.select():
+                if key.data is None:
+                    self._accept()
+                else:
+                    self._read(key.data)
+
+    def server_close(self):
+        for key in list(self._selector.get_map().values()):
+            key.fileobj.close()
+        self._selector.close()
+
+    def _accept(self):
+        sock, _ = self._listener.accept()
+        sock.setblocking(False)
+        client = Client(sock)
+        self._selector.register(sock, selectors.EVENT_READ, client)
+        self._connections.mark()
+        logger.info("{} connected".format(client.name))
+
+    def _read(self, client: Client):
+        try:
+            data = client.socket.recv(RECEIVE_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+
+        if not data:
+            self._close(client)
+            return
+
+        self._bytes_received.mark(len(data))
+        commands = client.decoder.feed(data)
+        self._messages.mark(len(commands))
+        for key, value in commands:
+            if key == protocol.PROTOCOL_KEY and value == protocol.PROTOCOL_BINARY:
+                client.socket.send(protocol.hello(protocol.PROTOCOL_BINARY))
+        if commands:
+            self._renderer.submit(client, commands)
+
+    def _close(self, client: Client):
+        self._selector.unregister(client.socket)
+        client.socket.close()
+        self._renderer.submit(client, [("close", "")])
+        logger.info("{} disconnected".format(client.name))
+
 
 if __name__ == '__main__':
     log_path = "/tmp/plugin_neopixel_illumination_api.log"
+    state_path = None
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "l:")
+        opts, args = getopt.getopt(sys.argv[1:], "l:s:")
     except getopt.GetoptError:
-        print(f"{sys.argv[0]} -l <log path>")
+        print(f"{sys.argv[0]} -l <log path> [-s <state path>]")
         sys.exit(2)
 
     for opt, arg in opts:
         if opt == "-l":
             log_path = arg
+        elif opt == "-s":
+            state_path = arg
 
     setup_logger(log_path)
 
@@ -104,5 +589,11 @@ if __name__ == '__main__':
         if os.path.exists(SOCKET_SERVER_ADDRESS):
             raise
 
-    with ThreadedUnixStreamServer(SOCKET_SERVER_ADDRESS, Handler) as server:
+    renderer = Renderer(state_path=state_path)
+    renderer.restore_state()
+    renderer.start()
+
+    with SelectorServer(SOCKET_SERVER_ADDRESS, renderer) as server:
+        # The plugin waits for this line before connecting.
+        print(protocol.READY_MESSAGE, flush=True)
         server.serve_forever()
@@ -14,6 +14,37 @@ $(function () {
         self.currentColor = ko.observable();
         self.currentBrightness = ko.observable();
 
+        // Trailing edge throttle, so dragging the picker sends a bounded number of requests
+        // while the last value always gets through.
+        self.throttle = function (callback) {
+            let lastCall = 0;
+            let timeout = null;
+            let pendingArgs = null;
+
+            return function () {
+                pendingArgs = arguments;
+                if (timeout) {
+                    return;
+                }
+
+                let rate = self.settingsViewModel.settings.plugins.neopixel_illumination.max_update_rate() || 20;
+                let wait = Math.max(0, lastCall + 1000 / rate - Date.now());
+                timeout = setTimeout(function () {
+                    timeout = null;
+                    lastCall = Date.now();
+                    callback.apply(null, pendingArgs);
+                }, wait);
+            };
+        }
+
+        self.sendColor = self.throttle(function (color) {
+            OctoPrint.simpleApiCommand("neopixel_illumination", "update_color", {"color": color});
+        });
+
+        self.sendBrightness = self.throttle(function (brightness) {
+            OctoPrint.simpleApiCommand("neopixel_illumination", "update_brightness", {"value": brightness});
+        });
+
         self.onBeforeBinding = function () {
             self.currentColor(self.settingsViewModel.settings.plugins.neopixel_illumination.startup_color());
             self.currentBrightness(self.settingsViewModel.settings.plugins.neopixel_illumination.brightness());
@@ -27,11 +58,19 @@ $(function () {
             OctoPrint.simpleApiCommand("neopixel_illumination", "save_brightness")
         }
 
+        self.showPreset = function (preset) {
+            OctoPrint.simpleApiCommand("neopixel_illumination", "preset", {"name": preset.name()});
+            self.currentColor(preset.color());
+            if (preset.brightness() !== null && preset.brightness() !== "") {
+                self.currentBrightness(preset.brightness());
+            }
+        }
+
         self.updateColor = function (picker, event) {
             let newColor = event.currentTarget.value;
             if (newColor) {
                 self.currentColor(newColor);
-                OctoPrint.simpleApiCommand("neopixel_illumination", "update_color", {"color": newColor});
+                self.sendColor(newColor);
             }
         }
 
@@ -39,7 +78,7 @@ $(function () {
             let newBrightness = event.currentTarget.value;
             if (newBrightness) {
                 self.currentBrightness(newBrightness);
-                OctoPrint.simpleApiCommand("neopixel_illumination", "update_brightness", {"value": newBrightness});
+                self.sendBrightness(newBrightness);
             }
         }
     }
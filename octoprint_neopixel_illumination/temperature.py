@@ -0,0 +1,54 @@
+import math
+
+COLD = (0, 0, 255, 0)
+WARM = (255, 160, 0, 0)
+HOT = (255, 0, 0, 0)
+GRADIENT_STEPS = 16
+HYSTERESIS = 1.0
+
+
+def gradient(stops: list, steps: int) -> list:
+    """Precompute ``steps`` colors evenly spread over the color ``stops``."""
+    colors = []
+    for step in range(steps):
+        position = step * (len(stops) - 1) / max(steps - 1, 1)
+        index = min(int(position), len(stops) - 2)
+        t = position - index
+        start, end = stops[index], stops[index + 1]
+        colors.append(tuple(int(round(s + (e - s) * t)) for s, e in zip(start, end)))
+    return colors
+
+
+TEMPERATURE_GRADIENT = gradient([COLD, WARM, HOT], GRADIENT_STEPS)
+
+
+class TemperatureQuantizer:
+    """Maps one sensor's temperatures to a step of the gradient.
+
+    The step only moves once the temperature is ``hysteresis`` degrees past the
+    edge of the current one, so a reading that hovers around an edge doesn't
+    flip the color back and forth.
+    """
+
+    def __init__(self, minimum: float, maximum: float, steps: int = GRADIENT_STEPS, hysteresis: float = HYSTERESIS):
+        self.minimum = minimum
+        self.steps = steps
+        self.hysteresis = hysteresis
+        self.step: int = None
+        self._width = (maximum - minimum) / steps
+        # Readings within [lower, upper) keep the current step.
+        self._lower = math.inf
+        self._upper = -math.inf
+
+    def update(self, temperature: float) -> bool:
+        """Return true if ``temperature`` moved the sensor to another step."""
+        if self._lower <= temperature < self._upper:
+            return False
+
+        step = min(max(math.floor((temperature - self.minimum) / self._width), 0), self.steps - 1)
+        if step == self.step:
+            return False
+        self.step = step
+        self._lower = -math.inf if step == 0 else self.minimum + step * self._width - self.hysteresis
+        self._upper = math.inf if step == self.steps - 1 else self.minimum + (step + 1) * self._width + self.hysteresis
+        return True
@@ -0,0 +1,161 @@
+import collections
+import logging
+import threading
+import time
+
+from .metrics import Metrics
+
+IDLE_INTERVAL = 0.05
+OUTPUT_QUEUE_SIZE = 1024
+
+
+class PixelOutputWorker:
+    """Runs pixel operations on a dedicated thread.
+
+    Every operation is queued under a key. Submitting an operation whose key is
+    already pending replaces it and moves it to the back of the queue, so the
+    latest write wins and bursts of fills, brightness changes or shows collapse
+    into one. Operations submitted with a key of ``None`` are never coalesced.
+
+    When the queue is empty, ``idle`` is called every ``idle_interval`` seconds
+    for as long as it returns true, e.g. to drain output that is still buffered.
+
+    ``output_latency`` records how long operations took from being submitted to
+    being done, counted from the first of any that were coalesced. The
+    ``output_coalesced`` and ``output_dropped`` meters count the operations that
+    were replaced or didn't fit the queue.
+    """
+
+    def __init__(
+        self,
+        logger: logging.Logger,
+        maxsize: int = OUTPUT_QUEUE_SIZE,
+        idle=None,
+        idle_interval: float = IDLE_INTERVAL,
+        metrics: Metrics = None,
+    ):
+        metrics = metrics or Metrics()
+        self._latency = metrics.histogram("output_latency")
+        self._coalesced = metrics.meter("output_coalesced")
+        self._dropped = metrics.meter("output_dropped")
+        self._logger = logger
+        self._maxsize = maxsize
+        self._idle = idle
+        self._idle_interval = idle_interval
+        self._pending = collections.OrderedDict()
+        self._condition = threading.Condition()
+        self._running = False
+        self._thread: threading.Thread = None
+
+    def start(self):
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name="NeoPixelOutput", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = None):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def submit(self, key, function, *args):
+        submitted = time.monotonic()
+        with self._condition:
+            if key is None:
+                key = object()
+            else:
+                replaced = self._pending.pop(key, None)
+                if replaced is not None:
+                    # The wait is counted from the operation that was replaced.
+                    submitted = replaced[2]
+                    self._coalesced.mark()
+            if len(self._pending) >= self._maxsize:
+                dropped_key, _ = self._pending.popitem(last=False)
+                self._dropped.mark()
+                self._logger.debug("Output queue full, dropped `{}`".format(dropped_key))
+            self._pending[key] = (function, args, submitted)
+            self._condition.notify()
+
+    def _run(self):
+        idle_pending = False
+        while True:
+            with self._condition:
+                if self._running and not self._pending:
+                    self._condition.wait(self._idle_interval if idle_pending else None)
+                if self._pending:
+                    _, (function, args, submitted) = self._pending.popitem(last=False)
+                elif not self._running:
+                    return
+                else:
+                    function, args, submitted = self._idle, (), None
+
+            if function is None:
+                idle_pending = False
+                continue
+            idle_pending = self._call(function, *args) or function is not self._idle
+            if submitted is not None:
+                self._latency.observe(time.monotonic() - submitted)
+
+    def _call(self, function, *args):
+        try:
+            return function(*args)
+        except Exception:
+            self._logger.exception("Pixel output failed.")
+
+
+class Throttle:
+    """Runs a function at most ``rate`` times per second.
+
+    Calls arriving too soon are not dropped: the latest one is kept and run on
+    the trailing edge, once the interval has passed. Once ``cancel`` returns no
+    call from before it runs anymore, so the function must not call the
+    throttle itself.
+    """
+
+    def __init__(self, rate: float):
+        self._interval = 0.0
+        self._last_call = 0.0
+        self._pending = None
+        self._timer: threading.Timer = None
+        self._lock = threading.Lock()
+        self.set_rate(rate)
+
+    def set_rate(self, rate: float):
+        self._interval = 1.0 / rate if rate and rate > 0 else 0.0
+
+    def call(self, function, *args):
+        with self._lock:
+            self._pending = (function, args)
+            if self._timer is not None:
+                return
+            wait = self._last_call + self._interval - time.monotonic()
+            if wait > 0:
+                self._timer = threading.Timer(wait, self._flush)
+                self._timer.daemon = True
+                self._timer.start()
+                return
+
+        self._flush()
+
+    def cancel(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._pending = None
+
+    def _flush(self):
+        with self._lock:
+            self._timer = None
+            if self._pending is None:
+                return
+            function, args = self._pending
+            self._pending = None
+            self._last_call = time.monotonic()
+            # Under the lock, so a cancel waits for a call that already started.
+            function(*args)
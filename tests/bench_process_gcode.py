@@ -0,0 +1,73 @@
+"""Per-line overhead of the process_gcode hook for lines that are not M150.
+
+Compares the hook with the check it ran on every line before it kept a snapshot of its settings, two settings lookups
+and an upper-cased prefix match. Both run against OctoPrint's real settings, so OctoPrint has to be installed:
+
+    python tests/bench_process_gcode.py
+"""
+import logging
+import os
+import sys
+import tempfile
+import timeit
+
+import octoprint.plugin
+import octoprint.settings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from octoprint_neopixel_illumination import (  # noqa: E402
+    ENABLED_KEY,
+    PARSE_GCODE_KEY,
+    SET_COLOR_GCODE,
+    NeopixelIlluminationPlugin,
+)
+
+REPEAT = 5
+CMD = "G1 X10.5 Y20.25 E0.0321"
+GCODE = "G1"
+
+
+def create_plugin(basedir: str) -> NeopixelIlluminationPlugin:
+    settings = octoprint.settings.settings(init=True, basedir=basedir)
+    plugin = NeopixelIlluminationPlugin()
+    plugin._identifier = "neopixel_illumination"
+    plugin._logger = logging.getLogger("bench")
+    plugin._settings = octoprint.plugin.PluginSettings(
+        settings, plugin._identifier, defaults=plugin.get_settings_defaults()
+    )
+    plugin._settings.set([ENABLED_KEY], True)
+    plugin._settings.set([PARSE_GCODE_KEY], True)
+    plugin.on_settings_initialized()
+    return plugin
+
+
+def process_gcode_before(plugin: NeopixelIlluminationPlugin, cmd: str, gcode: str):
+    if (
+        plugin._settings.get([ENABLED_KEY])
+        and plugin._settings.get([PARSE_GCODE_KEY])
+        and gcode.upper().startswith(SET_COLOR_GCODE)
+    ):
+        raise AssertionError("Benchmark lines must not be M150")
+
+
+def per_line(function) -> float:
+    """Best of ``REPEAT`` runs of as many lines as take at least 0.2 seconds, in seconds per line."""
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(REPEAT, number)) / number
+
+
+def main():
+    with tempfile.TemporaryDirectory() as basedir:
+        plugin = create_plugin(basedir)
+        timings = {
+            "before": per_line(lambda: process_gcode_before(plugin, CMD, GCODE)),
+            "after": per_line(lambda: plugin.process_gcode(None, "queuing", CMD, None, GCODE, None, None)),
+        }
+    for name, seconds in timings.items():
+        print("{:>6}: {:9.0f} ns/line".format(name, seconds * 1e9))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,10 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The protocol and the mocks are imported the way sock_api.py imports them, as top level modules, so the tests don't
+# need OctoPrint to import the plugin package.
+sys.path.insert(0, os.path.join(ROOT, "octoprint_neopixel_illumination"))
+# The plugin package itself needs OctoPrint, tests that import it skip when it isn't installed.
+sys.path.insert(0, ROOT)
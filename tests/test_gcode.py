@@ -0,0 +1,76 @@
+import io
+import logging
+
+import pytest
+
+pytest.importorskip("octoprint")
+
+from gcode import M150Command, M150IndexStream, index_path, load_index, parse_m150, remove_index  # noqa: E402
+
+
+def test_parse_m150():
+    assert parse_m150("M150 R255 U50 B100 W0") == M150Command(-1, (255, 50, 100, 0), None, 0.0, 0, None)
+    assert parse_m150("M150 I3 P128 S1") == M150Command(3, None, 128 / 255, 0.0, 1, None)
+    # Lower case and without spaces, the way some slicers write it.
+    assert parse_m150("m150r10u20") == M150Command(-1, (10, 20, 0, 0), None, 0.0, 0, None)
+
+
+def test_parse_m150_extensions():
+    assert parse_m150("M150 R255 D1500") == M150Command(-1, (255, 0, 0, 0), None, 1.5, 0, None)
+    # A fade without a color only fades the brightness.
+    assert parse_m150("M150 P0 D500") == M150Command(-1, None, 0.0, 0.5, 0, None)
+    assert parse_m150("M150 Q2") == M150Command(-1, None, None, 0.0, 0, 2)
+
+
+@pytest.mark.parametrize("cmd", ["M150 R256", "M150 U300", "M150 B1000", "M150 W256", "M150 P256"])
+def test_parse_m150_out_of_range(cmd):
+    with pytest.raises(ValueError):
+        parse_m150(cmd)
+
+
+def index_upload(folder: str, path: str, lines: list) -> bytes:
+    stream = M150IndexStream(io.BytesIO(b"".join(lines)), folder, path, logging.getLogger("test"))
+    return stream.read()
+
+
+def test_index_round_trip(tmp_path):
+    folder = str(tmp_path / "index")
+    lines = [
+        b"G28\n",
+        b"M150 R255 ; red\n",
+        b"  m150 U255\n",
+        b"M150 R255 ; red again\n",
+        b"M150 R999\n",
+        b"G1 X10\n",
+    ]
+
+    # The upload passes through unchanged.
+    assert index_upload(folder, "a.gcode", lines) == b"".join(lines)
+    # Keyed the way OctoPrint sends the commands, invalid ones are left out.
+    assert load_index(folder, "a.gcode") == {
+        "M150 R255": M150Command(-1, (255, 0, 0, 0), None, 0.0, 0, None),
+        "m150 U255": M150Command(-1, (0, 255, 0, 0), None, 0.0, 0, None),
+    }
+
+    remove_index(folder, "a.gcode")
+    assert load_index(folder, "a.gcode") == {}
+    remove_index(folder, "a.gcode")
+
+
+def test_index_without_m150(tmp_path):
+    folder = str(tmp_path)
+    index_upload(folder, "a.gcode", [b"M150 R1\n"])
+    # Uploading the file again without any M150 drops its old index.
+    index_upload(folder, "a.gcode", [b"G28\n"])
+    assert load_index(folder, "a.gcode") == {}
+
+
+def test_load_index_of_another_file(tmp_path):
+    folder = str(tmp_path)
+    index_upload(folder, "a.gcode", [b"M150 R1\n"])
+    with open(index_path(folder, "a.gcode")) as index_file:
+        data = index_file.read()
+    with open(index_path(folder, "b.gcode"), "w") as index_file:
+        index_file.write(data)
+    assert load_index(folder, "b.gcode") == {}
+    assert load_index(folder, "missing.gcode") == {}
@@ -0,0 +1,85 @@
+import time
+
+import pytest
+
+from metrics import Histogram, Meter, Metrics
+
+
+class Clock:
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(time, "monotonic", clock)
+    return clock
+
+
+def test_meter_rate_over_the_whole_window(clock):
+    meter = Meter(window=10)
+    for second in range(12):
+        clock.now = 1000 + second + 0.5
+        meter.mark(100)
+
+    # The second in progress is left out, the ten before it are all counted.
+    assert meter.rate() == 100
+    clock.now = 1012.5
+    assert meter.rate() == 100
+    assert meter.total == 1200
+
+
+def test_meter_rate_forgets_old_seconds(clock):
+    meter = Meter(window=10)
+    clock.now = 1005.5
+    meter.mark(10)
+
+    clock.now = 1006.0
+    assert meter.rate() == 1.0
+    clock.now = 1015.9
+    assert meter.rate() == 1.0
+    clock.now = 1016.0
+    assert meter.rate() == 0.0
+
+    # A mark long after reuses the slot of the old second without its count.
+    clock.now = 1027.5
+    meter.mark(5)
+    clock.now = 1028.0
+    assert meter.rate() == 0.5
+    assert meter.total == 15
+
+
+def test_histogram():
+    histogram = Histogram(bounds=(0.001, 0.01, 0.1))
+    for value in (0.0005, 0.0005, 0.005, 0.05, 0.001):
+        histogram.observe(value)
+
+    assert histogram.counts == [3, 1, 1, 0]
+    assert histogram.count == 5
+    assert histogram.sum == pytest.approx(0.057)
+    assert histogram.quantile(0.5) == 0.001
+    assert histogram.quantile(0.7) == 0.01
+    assert histogram.quantile(0.99) == 0.1
+
+    # Quantiles in the unbounded bucket have no upper bound.
+    for _ in range(6):
+        histogram.observe(10)
+    assert histogram.quantile(0.99) is None
+    assert Histogram().quantile(0.5) is None
+
+
+def test_metrics_snapshot(clock):
+    metrics = Metrics()
+    # Instruments are created once and shared by name.
+    assert metrics.meter("frames") is metrics.meter("frames")
+    metrics.meter("frames").mark(3)
+    metrics.histogram("latency").observe(0.002)
+
+    snapshot = metrics.snapshot()
+    assert snapshot["meters"]["frames"]["total"] == 3
+    assert snapshot["histograms"]["latency"]["count"] == 1
+    assert snapshot["histograms"]["latency"]["p50"] == 0.002
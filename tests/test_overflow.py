@@ -0,0 +1,112 @@
+import logging
+import socket
+import threading
+import time
+
+import pytest
+
+import protocol
+from metrics import Metrics
+from mocks.microcontroller import Pin
+from mocks.neopixel import OVERFLOW_POLICIES, NeoPixel, SocketNeoPixelDelegate
+
+NUM_PIXELS = 300
+STALL = 0.5
+
+
+class StalledReader(threading.Thread):
+    """Accepts one connection and answers the hello, then stops reading for a while and decodes what arrives after."""
+
+    def __init__(self, path: str):
+        super().__init__(daemon=True)
+        self.commands = []
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listener.bind(path)
+        self._listener.listen()
+
+    def run(self):
+        client, _ = self._listener.accept()
+        with client:
+            decoder = protocol.Decoder()
+            self.commands.extend(decoder.feed(client.recv(len(protocol.hello(protocol.PROTOCOL_BINARY)))))
+            client.send(protocol.hello(protocol.PROTOCOL_BINARY))
+            time.sleep(STALL)
+            client.settimeout(STALL)
+            try:
+                while True:
+                    data = client.recv(65536)
+                    if not data:
+                        break
+                    self.commands.extend(decoder.feed(data))
+            except socket.timeout:
+                pass
+        self._listener.close()
+
+    def frame(self) -> bytearray:
+        frame = bytearray(NUM_PIXELS * protocol.BYTES_PER_PIXEL)
+        for key, value in self.commands:
+            assert key != "error", value
+            if key == "fill":
+                frame[:] = bytes(value) * NUM_PIXELS
+            elif key == "pixel":
+                index, color = value
+                frame[index * protocol.BYTES_PER_PIXEL:(index + 1) * protocol.BYTES_PER_PIXEL] = bytes(color)
+            elif key == "frame":
+                start, data = value
+                frame[start * protocol.BYTES_PER_PIXEL:start * protocol.BYTES_PER_PIXEL + len(data)] = data
+        return frame
+
+
+def stalled_strip(tmp_path, overflow_policy: str, buffer_size: int):
+    reader = StalledReader(str(tmp_path / "socket"))
+    reader.start()
+    metrics = Metrics()
+    delegate = SocketNeoPixelDelegate(
+        str(tmp_path / "socket"), logging.getLogger("test"),
+        overflow_policy=overflow_policy, buffer_size=buffer_size, metrics=metrics,
+    )
+    return reader, metrics, delegate, NeoPixel(Pin(18), NUM_PIXELS, auto_write=False, delegate=delegate)
+
+
+def drain(reader: StalledReader, delegate: SocketNeoPixelDelegate):
+    while delegate.flush():
+        time.sleep(0.01)
+    reader.join()
+    delegate.close()
+
+
+@pytest.mark.parametrize("overflow_policy", OVERFLOW_POLICIES)
+def test_stalled_reader_converges(tmp_path, overflow_policy):
+    reader, metrics, delegate, pixels = stalled_strip(tmp_path, overflow_policy, 20000)
+
+    # Far more than the socket holds while nobody reads it.
+    for i in range(1000):
+        pixels[i % NUM_PIXELS] = (i % 256, 1, 2, 3)
+        pixels[i * 7 % NUM_PIXELS] = (5, 5, 5, 5)
+        pixels.show()
+    drain(reader, delegate)
+
+    # Frames were given up on the way, yet the reader ends up with what was written last.
+    meters = metrics.snapshot()["meters"]
+    assert meters["frames_dropped"]["total"] + meters["frames_coalesced"]["total"] > 0
+    assert meters["frames"]["total"] > sum(1 for key, _ in reader.commands if key == "frame")
+    assert reader.frame() == pixels._pixel_buffer
+
+
+@pytest.mark.parametrize("overflow_policy", OVERFLOW_POLICIES)
+def test_last_frame_dropped_by_other_messages_is_resent(tmp_path, overflow_policy):
+    reader, metrics, delegate, pixels = stalled_strip(tmp_path, overflow_policy, 3000)
+
+    for _ in range(400):
+        pixels.show()
+    pixels[:] = [(i % 256, 1, 2, 3) for i in range(NUM_PIXELS)]
+    pixels.show()
+    # No frame follows, only messages that push the last one out of the queue.
+    for i in range(400):
+        pixels.brightness = i / 400
+    drain(reader, delegate)
+
+    assert reader.frame() == pixels._pixel_buffer
+    # The show that went out without the frame is repeated after it.
+    last_frame = max(i for i, (key, _) in enumerate(reader.commands) if key == "frame")
+    assert ("show", "") in reader.commands[last_frame:]
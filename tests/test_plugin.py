@@ -0,0 +1,39 @@
+import pytest
+
+pytest.importorskip("octoprint")
+
+from werkzeug.exceptions import BadRequest  # noqa: E402
+
+from octoprint_neopixel_illumination import SEQUENCE_WINDOW, NeopixelIlluminationPlugin  # noqa: E402
+
+
+def test_accept_sequence():
+    plugin = NeopixelIlluminationPlugin()
+    accept = plugin._accept_sequence
+
+    # Frames without a sequence number are always taken.
+    assert accept(0, None)
+    assert accept(0, None)
+
+    assert accept(0, 5)
+    assert not accept(0, 5)
+    assert not accept(0, 4)
+    assert accept(0, 7)
+    # Every strip counts on its own.
+    assert accept(1, 1)
+    assert not accept(0, 6)
+
+    # Far behind the last one is a sender that started counting again.
+    assert accept(0, 7 - SEQUENCE_WINDOW)
+    assert not accept(0, 7 - SEQUENCE_WINDOW)
+
+
+@pytest.mark.parametrize("data", [
+    {"name": "sparkle"},
+    {"name": "rainbow", "params": {"name": "chase"}},
+    {"name": "breathe", "params": {"current": None}},
+    {"name": "chase", "params": ["red"]},
+])
+def test_invalid_effect_is_rejected(data):
+    with pytest.raises(BadRequest):
+        NeopixelIlluminationPlugin().on_api_command("start_effect", data)
@@ -0,0 +1,99 @@
+import protocol
+
+FRAME = bytes(range(12))
+
+
+def encode_all(encoder) -> bytes:
+    return b"".join([
+        encoder.init({"pin": 18, "n": 3}),
+        encoder.fill(1, 2, 3, 4),
+        encoder.set_item(2, 5, 6, 7, 8),
+        encoder.set_brightness(0.5),
+        encoder.set_frame(1, FRAME[4:]),
+        encoder.select_layer(protocol.LAYER_GCODE, protocol.BLEND_ADD),
+        encoder.clear_layer(protocol.LAYER_STATUS),
+        encoder.define_preset("night", None, FRAME),
+        encoder.preset("night"),
+        encoder.release(1),
+        encoder.show(),
+    ])
+
+
+EXPECTED = [
+    ("init", {"pin": 18, "n": 3}),
+    ("fill", (1, 2, 3, 4)),
+    ("pixel", (2, (5, 6, 7, 8))),
+    ("brightness", 0.5),
+    ("frame", (1, FRAME[4:])),
+    ("layer", {"name": protocol.LAYER_GCODE, "blend": protocol.BLEND_ADD}),
+    ("clear_layer", protocol.LAYER_STATUS),
+    ("define_preset", {"name": "night", "brightness": None, "frame": FRAME}),
+    ("preset", "night"),
+    ("release", 1),
+    ("show", ""),
+]
+
+
+def normalize(commands: list) -> list:
+    # JSON carries tuples as lists.
+    normalized = []
+    for key, value in commands:
+        if key == "fill":
+            value = tuple(value)
+        elif key == "pixel":
+            value = (value[0], tuple(value[1]))
+        elif key == "frame":
+            value = tuple(value)
+        normalized.append((key, value))
+    return normalized
+
+
+def binary_decoder() -> protocol.Decoder:
+    decoder = protocol.Decoder()
+    assert decoder.feed(protocol.hello(protocol.PROTOCOL_BINARY)) == [(protocol.PROTOCOL_KEY, protocol.PROTOCOL_BINARY)]
+    return decoder
+
+
+def test_json_and_binary_decode_the_same():
+    assert normalize(protocol.Decoder().feed(encode_all(protocol.JsonEncoder()))) == EXPECTED
+    assert normalize(binary_decoder().feed(encode_all(protocol.BinaryEncoder()))) == EXPECTED
+
+
+def test_split_reads():
+    for encoder, decoder in [(protocol.JsonEncoder(), protocol.Decoder()), (protocol.BinaryEncoder(), binary_decoder())]:
+        data = encode_all(encoder)
+        commands = []
+        for i in range(len(data)):
+            commands.extend(decoder.feed(data[i:i + 1]))
+        assert normalize(commands) == EXPECTED
+
+
+def test_hello_and_binary_in_one_read():
+    data = protocol.hello(protocol.PROTOCOL_BINARY) + encode_all(protocol.BinaryEncoder())
+    commands = protocol.Decoder().feed(data)
+    assert commands[0] == (protocol.PROTOCOL_KEY, protocol.PROTOCOL_BINARY)
+    assert normalize(commands[1:]) == EXPECTED
+
+
+def test_unknown_hello_stays_on_json():
+    decoder = protocol.Decoder()
+    decoder.feed(protocol.hello("carrier-pigeon"))
+    assert decoder.protocol == protocol.PROTOCOL_JSON
+    assert normalize(decoder.feed(encode_all(protocol.JsonEncoder()))) == EXPECTED
+
+
+def test_invalid_messages_are_reported_and_skipped():
+    decoder = binary_decoder()
+    commands = decoder.feed(protocol.pack(0x7F, b"junk") + protocol.BinaryEncoder().show())
+    assert commands[0][0] == "error"
+    assert commands[1:] == [("show", "")]
+
+    commands = protocol.Decoder().feed(b"{not json\n" + protocol.JsonEncoder().show())
+    assert commands[0][0] == "error"
+    assert commands[1:] == [("show", "")]
+
+
+def test_effects_match_the_daemon():
+    import effects
+
+    assert sorted(effects.EFFECTS) == sorted(protocol.EFFECTS)
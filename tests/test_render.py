@@ -0,0 +1,180 @@
+import importlib.util
+import random
+import sys
+
+import pytest
+
+import protocol
+import render
+
+
+def load_python_backend():
+    """A second copy of the render module that doesn't find NumPy, whether it is installed or not."""
+    numpy = sys.modules.get("numpy")
+    sys.modules["numpy"] = None
+    try:
+        spec = importlib.util.spec_from_file_location("render_python", render.__file__)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        if numpy is None:
+            del sys.modules["numpy"]
+        else:
+            sys.modules["numpy"] = numpy
+    return module
+
+
+python_render = load_python_backend()
+BACKENDS = {module.BACKEND: module for module in (render, python_render)}
+
+
+@pytest.fixture(params=sorted(BACKENDS))
+def backend(request):
+    return BACKENDS[request.param]
+
+
+def frame_bytes(backend, frame) -> bytes:
+    return bytes(backend.frame_to_bytes(frame))
+
+
+def test_wire_channels():
+    assert render.wire_channels(None) == [1, 0, 2]
+    assert render.wire_channels("grbw") == [1, 0, 2, 3]
+    assert render.wire_channels("BGR") == [2, 1, 0]
+    for pixel_order in ("RG", "RGBWW", "RGX"):
+        with pytest.raises(ValueError):
+            render.wire_channels(pixel_order)
+
+
+@pytest.mark.parametrize("pixel_order, expected", [
+    ("RGB", "010203" "050607"),
+    ("GRB", "020103" "060507"),
+    ("BGR", "030201" "070605"),
+    ("RGBW", "01020304" "05060708"),
+    ("GRBW", "02010304" "06050708"),
+    ("WRGB", "04010203" "08050607"),
+])
+def test_to_wire(backend, pixel_order, expected):
+    frame = backend.frame_from_bytes(bytes(range(1, 9)))
+    channels = backend.channel_index(render.wire_channels(pixel_order))
+    out = bytearray(len(expected) // 2)
+    backend.to_wire(frame, channels, out)
+    assert out.hex() == expected
+
+    # The table applies to the reordered bytes.
+    backend.to_wire(frame, channels, out, backend.build_lut(0.5))
+    assert out == bytes(round(value * 0.5) for value in bytes.fromhex(expected))
+
+
+def test_layer_coverage(backend):
+    layer = backend.Layer(4)
+    assert not layer.active
+    layer.set_pixel(-1, (1, 2, 3, 4))
+    layer.write(1, bytes(range(8)))
+    assert layer.active
+    assert list(layer.mask) == [0, 1, 1, 1]
+
+    for start, data in [(-1, bytes(4)), (3, bytes(8)), (0, bytes(3))]:
+        with pytest.raises(ValueError):
+            layer.write(start, data)
+
+    layer.clear()
+    assert not layer.active
+
+    # The base layer always covers the strip, clearing it turns it black.
+    base = backend.Layer(2, covered=True)
+    base.fill((9, 9, 9, 9))
+    base.clear()
+    assert base.active
+    assert frame_bytes(backend, base.frame) == bytes(8)
+
+
+@pytest.mark.parametrize("blend, expected", [
+    (protocol.BLEND_NORMAL, (100, 100, 100, 255)),
+    (protocol.BLEND_ADD, (200, 255, 150, 255)),
+    (protocol.BLEND_MULTIPLY, (39, 78, 19, 0)),
+])
+def test_blend_modes(backend, blend, expected):
+    strip = backend.Strip(lambda data: None, 3)
+    strip.base.fill((100, 200, 50, 0))
+    overlay = strip.layer(protocol.LAYER_GCODE)
+    overlay.blend = blend
+    overlay.set_pixel(1, (100, 100, 100, 255))
+
+    # Pixels the layer doesn't cover show the layers below.
+    assert frame_bytes(backend, strip.composite()) == bytes((100, 200, 50, 0) + expected + (100, 200, 50, 0))
+
+
+def test_composite_order(backend):
+    strip = backend.Strip(lambda data: None, 2)
+    strip.base.fill((1, 1, 1, 1))
+    strip.layer(protocol.LAYER_TEMPERATURE).set_pixel(0, (2, 2, 2, 2))
+    strip.layer(protocol.LAYER_ALERT).set_pixel(0, (5, 5, 5, 5))
+
+    assert frame_bytes(backend, strip.composite()) == bytes([5] * 4 + [1] * 4)
+    # Up to a layer, e.g. what an effect on that layer starts from.
+    assert frame_bytes(backend, strip.composite(protocol.LAYER_GCODE)) == bytes([2] * 4 + [1] * 4)
+    assert frame_bytes(backend, strip.composite(protocol.LAYER_BASE)) == bytes([1] * 8)
+
+    strip.clear_overlays()
+    assert frame_bytes(backend, strip.composite()) == bytes([1] * 8)
+
+
+def test_strip_show(backend):
+    written = []
+    strip = backend.Strip(written.append, 2, brightness=0.5, pixel_order="GRB")
+    strip.base.fill((200, 100, 50, 0))
+
+    assert strip.show()
+    assert bytes(written[0]) == bytes((50, 100, 25) * 2)
+    # The same frame again isn't written.
+    assert not strip.show()
+    assert (strip.shown, strip.skipped) == (1, 1)
+
+    strip.set_brightness(1.0)
+    assert strip.show()
+    assert bytes(written[1]) == bytes((100, 200, 50) * 2)
+    # Drivers get the same buffer every time.
+    assert written[0] is written[1]
+
+
+def test_strip_show_retries_failed_write(backend):
+    def write(data):
+        raise OSError("driver failed")
+
+    strip = backend.Strip(write, 2)
+    strip.base.fill((1, 2, 3, 4))
+    with pytest.raises(OSError):
+        strip.show()
+
+    written = []
+    strip.write = written.append
+    assert strip.show()
+    assert len(written) == 1
+
+
+@pytest.mark.skipif(len(BACKENDS) < 2, reason="needs NumPy")
+@pytest.mark.parametrize("seed", range(5))
+def test_backends_agree(seed):
+    rng = random.Random(seed)
+    num_pixels = 37
+    pixel_order = rng.choice(["RGB", "GRB", "BRG", "RGBW", "GRBW"])
+    brightness = rng.choice([1.0, 0.5, 0.03])
+    gamma = rng.choice([1.0, 2.2])
+
+    outputs = []
+    for backend in BACKENDS.values():
+        # Both strips get the same writes.
+        writes = random.Random(seed)
+        strip = backend.Strip(lambda data: None, num_pixels, brightness, gamma, pixel_order)
+        strip.base.write(0, bytes(writes.randrange(256) for _ in range(num_pixels * 4)))
+        for name in protocol.LAYERS[1:]:
+            layer = strip.layer(name)
+            layer.blend = writes.choice(protocol.BLEND_MODES)
+            start = writes.randrange(num_pixels)
+            count = writes.randrange(1, num_pixels - start + 1)
+            layer.write(start, bytes(writes.randrange(256) for _ in range(count * 4)))
+            layer.set_pixel(writes.randrange(num_pixels), (writes.randrange(256),) * 4)
+        outputs.append((frame_bytes(backend, strip.composite()), strip.output()))
+
+    assert outputs[0] == outputs[1]
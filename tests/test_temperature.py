@@ -0,0 +1,36 @@
+from temperature import COLD, HOT, TemperatureQuantizer, gradient
+
+
+def test_gradient_spans_the_stops():
+    colors = gradient([COLD, HOT], 5)
+    assert len(colors) == 5
+    assert colors[0] == COLD
+    assert colors[-1] == HOT
+
+
+def test_quantizer_steps():
+    quantizer = TemperatureQuantizer(0, 100, steps=10, hysteresis=1.0)
+    assert quantizer.update(25)
+    assert quantizer.step == 2
+    # Below the minimum and above the maximum stay on the first and last step.
+    assert quantizer.update(-20)
+    assert quantizer.step == 0
+    assert quantizer.update(500)
+    assert quantizer.step == 9
+
+
+def test_quantizer_hysteresis():
+    quantizer = TemperatureQuantizer(0, 100, steps=10, hysteresis=1.0)
+    quantizer.update(25)
+
+    # Hovering around the edge at 30 doesn't move the step until a degree past it.
+    for temperature in (29.5, 30.5, 29.9, 30.9, 20.0):
+        assert not quantizer.update(temperature)
+        assert quantizer.step == 2
+    assert quantizer.update(31.0)
+    assert quantizer.step == 3
+
+    # And the same on the way down.
+    assert not quantizer.update(29.5)
+    assert quantizer.update(28.9)
+    assert quantizer.step == 2
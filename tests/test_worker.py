@@ -0,0 +1,99 @@
+import logging
+import time
+
+import pytest
+
+pytest.importorskip("octoprint")
+
+from octoprint_neopixel_illumination.metrics import Metrics  # noqa: E402
+from octoprint_neopixel_illumination.worker import PixelOutputWorker, Throttle  # noqa: E402
+
+
+def run_queued(worker: PixelOutputWorker):
+    # Stopping drains the queue, so everything submitted before starting runs in queue order.
+    worker.start()
+    worker.stop(5)
+
+
+def test_worker_coalesces_by_key():
+    metrics = Metrics()
+    worker = PixelOutputWorker(logging.getLogger("test"), metrics=metrics)
+    calls = []
+    worker.submit("fill", calls.append, "red")
+    worker.submit("show", calls.append, "show")
+    worker.submit(None, calls.append, "pixel 1")
+    worker.submit(None, calls.append, "pixel 2")
+    worker.submit("fill", calls.append, "green")
+    run_queued(worker)
+
+    # The latest fill replaces the pending one and moves behind what was submitted in between.
+    assert calls == ["show", "pixel 1", "pixel 2", "green"]
+    meters = metrics.snapshot()["meters"]
+    assert meters["output_coalesced"]["total"] == 1
+    assert metrics.snapshot()["histograms"]["output_latency"]["count"] == 4
+
+
+def test_worker_drops_oldest_when_full():
+    metrics = Metrics()
+    worker = PixelOutputWorker(logging.getLogger("test"), maxsize=2, metrics=metrics)
+    calls = []
+    for i in range(3):
+        worker.submit(i, calls.append, i)
+    run_queued(worker)
+
+    assert calls == [1, 2]
+    assert metrics.snapshot()["meters"]["output_dropped"]["total"] == 1
+
+
+def test_worker_survives_failing_operations():
+    worker = PixelOutputWorker(logging.getLogger("test"))
+    calls = []
+    worker.submit("a", lambda: 1 / 0)
+    worker.submit("b", calls.append, "b")
+    run_queued(worker)
+    assert calls == ["b"]
+
+
+def test_worker_idle():
+    idle_calls = []
+
+    def idle():
+        idle_calls.append(None)
+        # Keep being called until there is nothing left to flush.
+        return len(idle_calls) < 3
+
+    worker = PixelOutputWorker(logging.getLogger("test"), idle=idle, idle_interval=0.01)
+    worker.start()
+    worker.submit("show", lambda: None)
+    time.sleep(0.3)
+    worker.stop(5)
+    assert len(idle_calls) == 3
+
+
+def test_throttle_trailing_edge():
+    throttle = Throttle(10)
+    calls = []
+    # The first call runs right away, of the ones arriving too soon only the last runs, once the interval is over.
+    for i in range(5):
+        throttle.call(calls.append, i)
+    assert calls == [0]
+    time.sleep(0.3)
+    assert calls == [0, 4]
+
+
+def test_throttle_cancel():
+    throttle = Throttle(10)
+    calls = []
+    throttle.call(calls.append, 0)
+    throttle.call(calls.append, 1)
+    throttle.cancel()
+    time.sleep(0.3)
+    assert calls == [0]
+
+
+def test_throttle_without_rate():
+    throttle = Throttle(0)
+    calls = []
+    for i in range(5):
+        throttle.call(calls.append, i)
+    assert calls == [0, 1, 2, 3, 4]